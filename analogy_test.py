@@ -2,32 +2,77 @@
 import os
 import logging
 import json
+from functools import lru_cache
 
-import pandas as pd
 import numpy as np
-from util import wget, get_word_embedding_model
+from util import wget, get_embedding_matrix, source_stamp, MODEL_REGISTRY
+from pair_store import PairStore, pair_key, get_pair_store
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
 
-def get_analogy_data():
-    """ Get SAT-type dataset: a list of (answer: int, prompts: list, stem: list, choice: list)"""
+ANALOGY_DATA = ['bats', 'sat', 'u2', 'u4', 'google']
+
+
+def _analogy_data_path(data_name: str, split: str):
+    """ Path to the jsonl file of a dataset split, downloaded on the first call """
     cache_dir = './cache'
     os.makedirs(cache_dir, exist_ok=True)
     root_url_analogy = 'https://github.com/asahi417/AnalogyTools/releases/download/0.0.0/analogy_test_dataset.tar.gz'
     if not os.path.exists('{}/analogy_test_dataset'.format(cache_dir)):
         wget(root_url_analogy, cache_dir)
+    return '{}/analogy_test_dataset/{}/{}.jsonl'.format(cache_dir, data_name, split)
+
+
+def _read_jsonl(path: str):
+    with open(path, 'r') as f:
+        return list(filter(None, map(lambda x: json.loads(x) if len(x) > 0 else None, f.read().split('\n'))))
+
+
+@lru_cache(maxsize=None)
+def get_analogy_data():
+    """ Get SAT-type dataset: a list of (answer: int, prompts: list, stem: list, choice: list), loaded on the first call
+    and cached """
     data = {}
-    for d in ['bats', 'sat', 'u2', 'u4', 'google']:
-        with open('{}/analogy_test_dataset/{}/test.jsonl'.format(cache_dir, d), 'r') as f:
-            test_set = list(filter(None, map(lambda x: json.loads(x) if len(x) > 0 else None, f.read().split('\n'))))
-        with open('{}/analogy_test_dataset/{}/valid.jsonl'.format(cache_dir, d), 'r') as f:
-            val_set = list(filter(None, map(lambda x: json.loads(x) if len(x) > 0 else None, f.read().split('\n'))))
+    for d in ANALOGY_DATA:
+        test_set = _read_jsonl(_analogy_data_path(d, 'test'))
+        val_set = _read_jsonl(_analogy_data_path(d, 'valid'))
         data[d] = (val_set, test_set)
     return data
 
 
-full_data = get_analogy_data()
+def load_analogy_arrays(path: str):
+    """ Pre-parsed arrays of a jsonl dataset: the word table `words` and `pairs`/`mask` of `_index_questions`, with
+    `answer` and `pred_pmi` arrays. They are cached as `.npz` next to the jsonl, and rebuilt when the jsonl has changed.
+
+    :param path: path to the jsonl file
+    """
+    cache_path = '{}.npz'.format(os.path.splitext(path)[0])
+    stamp = json.dumps(source_stamp(path), sort_keys=True)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as f:
+            if str(f['stamp']) == stamp:
+                arrays = {k: f[k] for k in f.files if k != 'stamp'}
+                arrays['words'] = arrays['words'].tolist()
+                return arrays
+        logging.info('source of {} has changed, rebuilding cache'.format(cache_path))
+    data = _read_jsonl(path)
+    words, pairs, mask = _index_questions(data)
+    arrays = {'words': words, 'pairs': pairs.astype(np.int32), 'mask': mask,
+              'answer': np.array([o['answer'] for o in data], dtype=np.int64),
+              'pred_pmi': np.array([o.get('pred/pmi', -1) for o in data], dtype=np.int64)}
+    with open(cache_path + '.tmp', 'wb') as f:
+        np.savez(f, stamp=np.array(stamp), **dict(arrays, words=np.array(words, dtype=str)))
+    os.replace(cache_path + '.tmp', cache_path)
+    return arrays
+
+
+@lru_cache(maxsize=None)
+def get_analogy_arrays():
+    """ Get `load_analogy_arrays` of the SAT-type dataset: a dictionary of (valid, test), loaded on the first call and
+    cached """
+    return {d: (load_analogy_arrays(_analogy_data_path(d, 'valid')), load_analogy_arrays(_analogy_data_path(d, 'test')))
+            for d in ANALOGY_DATA}
 
 
 def embedding(term, model):
@@ -103,19 +148,123 @@ def get_prediction_we(stem, choice, embedding_model, add_feature_set='concat',
     return _pred
 
 
+def _index_questions(data):
+    """ Convert questions into a word table and an index array of the stem and choice pairs
+
+    :return: (words, pairs, mask) where `pairs` is an int array (question, 1 + choice, 2) holding the stem at the
+        first position of the second axis, and `mask` flags the positions of `pairs` which are not padding
+    """
+    words = {}
+    size = 1 + max(len(o['choice']) for o in data)
+    pairs = np.zeros((len(data), size, 2), dtype=np.int64)
+    mask = np.zeros((len(data), size), dtype=bool)
+    for n, o in enumerate(data):
+        for m, pair in enumerate([o['stem']] + o['choice']):
+            pairs[n, m] = [words.setdefault(w, len(words)) for w in pair]
+            mask[n, m] = True
+    return list(words), pairs, mask
+
+
+def gather_word_features(words, embedding_model):
+    """ Word embedding matrix of the word table with its OOV mask (zero vectors of size 3 when no model is given) """
+    if embedding_model is None:
+        return np.zeros((len(words), 3), dtype=np.float32), np.ones(len(words), dtype=bool)
+    return get_embedding_matrix(words, embedding_model)
+
+
+def gather_pair_features(words, pairs, pair_model):
+    """ Forward and reverse pair embeddings of the index array `pairs`, looked up once per unique pair
+
+    :param pair_model: `pair_store.PairStore` or gensim KeyedVectors of the pair embedding
+    """
+    unique, inverse = np.unique(pairs.reshape(-1, 2), axis=0, return_inverse=True)
+    inverse = inverse.reshape(pairs.shape[:-1])
+    word_pairs = [(words[a], words[b]) for a, b in unique]
+    if isinstance(pair_model, PairStore):
+        features = pair_model.lookup(word_pairs, bi_direction=True)
+    else:
+        features = [get_embedding_matrix([pair_key(a, b) for a, b in word_pairs], pair_model),
+                    get_embedding_matrix([pair_key(b, a) for a, b in word_pairs], pair_model)]
+    return tuple((matrix[inverse], found[inverse]) for matrix, found in features)
+
+
+def score_features(pairs, mask, word_features, pair_features, add_feature_set='concat', bi_direction: bool = False):
+    """ Predict the answer of every question from gathered features
+
+    :param pairs: index array from `_index_questions`
+    :param mask: padding mask from `_index_questions`
+    :param word_features: output of `gather_word_features`
+    :param pair_features: list of `gather_pair_features` outputs, in the order pair2vec then relative
+    :return: a list of predicted choice index, `None` for questions `get_prediction_we` can not answer
+    """
+    vectors, found = word_features
+    valid = mask & found[pairs].all(-1)
+
+    vec_a, vec_b = vectors[pairs[..., 0]], vectors[pairs[..., 1]]
+    feature = [vec_a, vec_b] if 'concat' in add_feature_set else []
+    if 'diff' in add_feature_set:
+        feature.append(vec_a - vec_b)
+    if 'dot' in add_feature_set:
+        feature.append(vec_a * vec_b)
+    assert len(feature)
+
+    for forward, reverse in pair_features:
+        for pair_e, pair_found in ([forward, reverse] if bi_direction else [forward]):
+            # pair embedding is added only when the stem has it, and then choices without it can not be scored;
+            # zero rows of the other questions leave their cosine similarity unchanged
+            stem_found = pair_found[:, :1]
+            feature.append(pair_e * stem_found[..., None])
+            valid &= pair_found | ~stem_found
+
+    feature = np.concatenate(feature, axis=-1)
+    norm = np.sqrt((feature * feature).sum(-1))
+    stem_e, choice_e = feature[:, 0], feature[:, 1:]
+    inner = np.matmul(choice_e, stem_e[..., None])[..., 0]
+    scored = valid[:, 1:] & valid[:, :1] & (norm[:, 1:] > 0) & (norm[:, :1] > 0)
+    score = np.where(scored, inner / np.where(scored, norm[:, 1:] * norm[:, :1], 1), -100)
+    pred = score.argmax(-1)
+    return [int(p) if scored[n, p] else None for n, p in enumerate(pred)]
+
+
+def get_prediction_batch(data, embedding_model, add_feature_set='concat', relative_model=None, pair2vec_model=None,
+                         bi_direction: bool = False):
+    """ Batched version of `get_prediction_we`, which scores every question of `data` at once
+
+    :return: a list of predicted choice index, `None` for questions `get_prediction_we` can not answer
+    """
+    words, pairs, mask = _index_questions(data)
+    word_features = gather_word_features(words, embedding_model)
+    pair_features = [gather_pair_features(words, pairs, m) for m in [pair2vec_model, relative_model] if m is not None]
+    return score_features(pairs, mask, word_features, pair_features, add_feature_set, bi_direction)
+
+
+# gathered features shared across feature patterns and `test_analogy` calls, keyed by (model, dataset, split)
+FEATURE_CACHE = {}
+
+
+def _cached_feature(key, function):
+    if key not in FEATURE_CACHE:
+        FEATURE_CACHE[key] = function()
+    return FEATURE_CACHE[key]
+
+
 def test_analogy(model_type, add_relative: bool = False, add_pair2vec: bool = False, bi_direction: bool = False,
-                 only_pair_embedding: bool = False):
+                 only_pair_embedding: bool = False, subset: bool = False):
+    """ Solve the analogy test datasets with a word embedding model
+
+    :param subset: load only the words of the benchmark datasets from the word embedding model
+    """
 
     model_re = None
     model_p2v = None
     if only_pair_embedding:
         model = None
     else:
-        model = get_word_embedding_model(model_type)
+        model = MODEL_REGISTRY.get(model_type, subset=subset)
     if add_relative:
-        model_re = get_word_embedding_model('relative_init.{}'.format(model_type))
+        model_re = get_pair_store('relative_init.{}'.format(model_type))
     if add_pair2vec:
-        model_p2v = get_word_embedding_model('pair2vec')
+        model_p2v = get_pair_store('pair2vec')
     if only_pair_embedding:
         assert model_p2v or model_re
     else:
@@ -125,23 +274,29 @@ def test_analogy(model_type, add_relative: bool = False, add_pair2vec: bool = Fa
         pattern = ['concat']
     else:
         pattern = ['diff', 'concat', ('diff', 'dot'), ('concat', 'dot')]
+    pair_model_names = [('pair2vec', model_p2v), ('relative_init.{}'.format(model_type), model_re)]
     results = []
 
     for _pattern in pattern:
-        for i, (val, test) in full_data.items():
+        for i, (val, test) in get_analogy_arrays().items():
             tmp_result = {'data': i, 'model': model_type, 'add_relative': add_relative, 'add_pair2vec': add_pair2vec,
                           'bi_direction': bi_direction, 'only_pair_embedding': only_pair_embedding}
             for prefix, data in zip(['test', 'valid'], [test, val]):
-                _pred = [get_prediction_we(o['stem'], o['choice'], model, _pattern, relative_model=model_re,
-                                           pair2vec_model=model_p2v, bi_direction=bi_direction)
-                         for o in data]
+                words, pairs, mask = data['words'], data['pairs'], data['mask']
+                word_features = _cached_feature(
+                    (None if model is None else model_type, i, prefix), lambda: gather_word_features(words, model))
+                pair_features = [
+                    _cached_feature((name, i, prefix), lambda: gather_pair_features(words, pairs, pair_model))
+                    for name, pair_model in pair_model_names if pair_model is not None]
+                _pred = score_features(pairs, mask, word_features, pair_features, _pattern, bi_direction)
                 tmp_result['oov_{}'.format(prefix)] = len([p for p in _pred if p is None])
                 # random prediction when OOV occurs
-                _pred = [p if p is not None else data[n]['pred/pmi'] for n, p in enumerate(_pred)]
-                accuracy = sum([o['answer'] == _pred[n] for n, o in enumerate(data)]) / len(_pred)
+                _pred = np.array([p if p is not None else data['pred_pmi'][n] for n, p in enumerate(_pred)])
+                accuracy = float((data['answer'] == _pred).mean())
                 tmp_result['accuracy_{}'.format(prefix)] = accuracy
-            tmp_result['accuracy'] = (tmp_result['accuracy_test'] * len(test) +
-                                      tmp_result['accuracy_valid'] * len(val)) / (len(val) + len(test))
+            tmp_result['accuracy'] = (tmp_result['accuracy_test'] * len(test['answer']) +
+                                      tmp_result['accuracy_valid'] * len(val['answer'])) / \
+                                     (len(val['answer']) + len(test['answer']))
             tmp_result['feature'] = _pattern
             results.append(tmp_result)
 
@@ -150,14 +305,15 @@ def test_analogy(model_type, add_relative: bool = False, add_pair2vec: bool = Fa
 
 def pmi_baseline():
     results = []
-    for i, (val, test) in full_data.items():
+    for i, (val, test) in get_analogy_arrays().items():
         tmp_result = {'data': i, 'model': 'PMI'}
         for prefix, data in zip(['test', 'valid'], [test, val]):
             tmp_result['oov_{}'.format(prefix)] = 0
-            accuracy = sum([o['answer'] == o['pred/pmi'] for n, o in enumerate(data)]) / len(data)
+            accuracy = float((data['answer'] == data['pred_pmi']).mean())
             tmp_result['accuracy_{}'.format(prefix)] = accuracy
-        tmp_result['accuracy'] = (tmp_result['accuracy_test'] * len(test) +
-                                  tmp_result['accuracy_valid'] * len(val)) / (len(val) + len(test))
+        tmp_result['accuracy'] = (tmp_result['accuracy_test'] * len(test['answer']) +
+                                  tmp_result['accuracy_valid'] * len(val['answer'])) / \
+                                 (len(val['answer']) + len(test['answer']))
         tmp_result['feature'] = None
         tmp_result['add_relative'] = None
         results.append(tmp_result)
@@ -165,29 +321,31 @@ def pmi_baseline():
 
 
 if __name__ == '__main__':
+    import pandas as pd
     full_result = pmi_baseline()
 
-    full_result += test_analogy('fasttext', add_pair2vec=True, bi_direction=True, only_pair_embedding=True)
-    full_result += test_analogy('fasttext', add_relative=True, bi_direction=True, only_pair_embedding=True)
+    full_result += test_analogy('fasttext', add_pair2vec=True, bi_direction=True, only_pair_embedding=True, subset=True)
+    full_result += test_analogy('fasttext', add_relative=True, bi_direction=True, only_pair_embedding=True, subset=True)
 
-    full_result += test_analogy('fasttext', add_pair2vec=True, bi_direction=True)
-    full_result += test_analogy('fasttext', add_pair2vec=True)
-    full_result += test_analogy('fasttext', add_relative=True, bi_direction=True)
-    full_result += test_analogy('fasttext', add_relative=True)
-    full_result += test_analogy('fasttext')
+    full_result += test_analogy('fasttext', add_pair2vec=True, bi_direction=True, subset=True)
+    full_result += test_analogy('fasttext', add_pair2vec=True, subset=True)
+    full_result += test_analogy('fasttext', add_relative=True, bi_direction=True, subset=True)
+    full_result += test_analogy('fasttext', add_relative=True, subset=True)
+    full_result += test_analogy('fasttext', subset=True)
 
-    full_result += test_analogy('glove', add_pair2vec=True, bi_direction=True)
-    full_result += test_analogy('glove', add_pair2vec=True)
-    full_result += test_analogy('glove', add_relative=True, bi_direction=True)
-    full_result += test_analogy('glove', add_relative=True)
-    full_result += test_analogy('glove')
+    full_result += test_analogy('glove', add_pair2vec=True, bi_direction=True, subset=True)
+    full_result += test_analogy('glove', add_pair2vec=True, subset=True)
+    full_result += test_analogy('glove', add_relative=True, bi_direction=True, subset=True)
+    full_result += test_analogy('glove', add_relative=True, subset=True)
+    full_result += test_analogy('glove', subset=True)
 
-    full_result += test_analogy('w2v', add_pair2vec=True, bi_direction=True)
-    full_result += test_analogy('w2v', add_pair2vec=True)
-    full_result += test_analogy('w2v', add_relative=True, bi_direction=True)
-    full_result += test_analogy('w2v', add_relative=True)
-    full_result += test_analogy('w2v')
+    full_result += test_analogy('w2v', add_pair2vec=True, bi_direction=True, subset=True)
+    full_result += test_analogy('w2v', add_pair2vec=True, subset=True)
+    full_result += test_analogy('w2v', add_relative=True, bi_direction=True, subset=True)
+    full_result += test_analogy('w2v', add_relative=True, subset=True)
+    full_result += test_analogy('w2v', subset=True)
 
+    logging.info('model registry: {}'.format(MODEL_REGISTRY.stats()))
     out = pd.DataFrame(full_result)
     out = out.sort_values(by=['data', 'model'])
     logging.info('finish evaluation:\n{}'.format(out))
@@ -0,0 +1,165 @@
+""" Approximate nearest neighbour search over unit-normalized word embeddings by an inverted file (IVF) index
+- the vectors are clustered by spherical k-means, and stored in the order of their cluster, so that each inverted list
+  is a contiguous block of the vector matrix
+- a query scans only the `nprobe` lists of the closest centroids, which trades the recall for the latency
+"""
+import os
+import json
+import logging
+
+import numpy as np
+from util import NATIVE_CACHE_DIR, source_stamp
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norm = np.sqrt((vectors * vectors).sum(-1, keepdims=True))
+    return vectors / np.where(norm > 0, norm, 1)
+
+
+def _assign(vectors, centroids, block_size: int = 65536):
+    """ index of the closest centroid of each vector """
+    return np.concatenate([
+        np.matmul(_normalize(vectors[start:start + block_size]), centroids.T).argmax(1)
+        for start in range(0, len(vectors), block_size)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+class IVFIndex:
+    """ Inverted file index over unit-normalized vectors """
+
+    def __init__(self, centroids, vectors, ids, offsets):
+        """ Inverted file index, see `IVFIndex.build`
+
+        :param centroids: array (n_list, dim) of the unit-normalized centroids
+        :param vectors: array (n, dim) of the unit-normalized vectors sorted by their list
+        :param ids: array (n,) of the original index of `vectors`
+        :param offsets: array (n_list + 1,) of the start of each list in `vectors`
+        """
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.position = np.empty(len(ids), dtype=np.int64)
+        self.position[ids] = np.arange(len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors, n_list: int = None, n_iter: int = 10, sample_size: int = None, dtype=np.float32,
+              seed: int = 0):
+        """ Build an index by spherical k-means over (a sample of) the vectors
+
+        :param vectors: array (n, dim) of the vectors, which are normalized in the index
+        :param n_list: number of the inverted lists, 4 * sqrt(n) by default
+        :param n_iter: iterations of k-means
+        :param sample_size: number of the vectors to train k-means, 64 * n_list by default
+        :param dtype: dtype to store the vectors (np.float16 halves the memory)
+        :param seed: random seed
+        """
+        rng = np.random.RandomState(seed)
+        n_list = n_list or max(int(4 * np.sqrt(len(vectors))), 1)
+        n_list = min(n_list, len(vectors))
+        sample_size = min(sample_size or 64 * n_list, len(vectors))
+        sample = _normalize(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, n_list, replace=False)]
+        for i in range(n_iter):
+            assignment = _assign(sample, centroids)
+            centroids = np.zeros_like(centroids)
+            np.add.at(centroids, assignment, sample)
+            # re-seed empty lists with random samples
+            empty = np.flatnonzero(np.bincount(assignment, minlength=n_list) == 0)
+            centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+            centroids = _normalize(centroids)
+            logging.info('k-means iteration {}/{}: {} empty lists'.format(i + 1, n_iter, len(empty)))
+        assignment = _assign(vectors, centroids)
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_list))])
+        sorted_vectors = np.empty((len(ids), vectors.shape[1]), dtype=dtype)
+        for start in range(0, len(ids), 65536):
+            # read the rows in ascending order, which is friendly to memory-mapped vectors
+            unique, inverse = np.unique(ids[start:start + 65536], return_inverse=True)
+            sorted_vectors[start:start + 65536] = _normalize(vectors[unique])[inverse]
+        return cls(centroids, sorted_vectors, ids, offsets)
+
+    def save(self, path: str, info=None):
+        """ save as `.npy` files in the directory `path`, with `info` in the meta data """
+        os.makedirs(path, exist_ok=True)
+        for name in ['centroids', 'vectors', 'ids', 'offsets']:
+            np.save('{}/{}.npy'.format(path, name), getattr(self, name))
+        with open('{}/meta.json'.format(path), 'w') as f:
+            json.dump({'size': len(self), 'n_list': len(self.centroids), 'info': info or {}}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode='r'):
+        """ load an index saved by `save`, memory-mapped read-only by default """
+        return cls(*[np.load('{}/{}.npy'.format(path, name), mmap_mode=mmap_mode)
+                     for name in ['centroids', 'vectors', 'ids', 'offsets']])
+
+    def vector(self, ids):
+        """ unit-normalized vectors of the original indices """
+        return np.asarray(self.vectors[self.position[ids]], dtype=np.float32)
+
+    def search(self, queries, topn: int = 5, nprobe: int = 16, exclude=None):
+        """ Approximate top-k by inner product, scanning the `nprobe` closest lists of each query. Queries are grouped by
+        list, so that each list is scored against all of its queries at once.
+
+        :param queries: array (query, dim) of unit-normalized queries
+        :param topn: number of the neighbours
+        :param nprobe: number of the lists to scan, larger for higher recall and latency
+        :param exclude: int array (query, m) of the original indices to exclude from the result of each query
+        :return: (ids, scores) arrays (query, topn) sorted by the score, where missing neighbours have id -1
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-np.matmul(queries, self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        cand_ids = np.full((len(queries), nprobe, topn), -1, dtype=np.int64)
+        cand_scores = np.full((len(queries), nprobe, topn), -np.inf, dtype=np.float32)
+        # (query, rank of the probe) sorted by the list
+        query_index, probe_rank = np.divmod(np.argsort(probe, axis=None, kind='stable'), nprobe)
+        lists = probe[query_index, probe_rank]
+        bounds = np.flatnonzero(np.concatenate([[True], lists[1:] != lists[:-1], [True]]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            lst = lists[start]
+            q, r = query_index[start:end], probe_rank[start:end]
+            ids = self.ids[self.offsets[lst]:self.offsets[lst + 1]]
+            if len(ids) == 0:
+                continue
+            score = np.matmul(queries[q], np.asarray(self.vectors[self.offsets[lst]:self.offsets[lst + 1]],
+                                                     dtype=np.float32).T)
+            if exclude is not None:
+                score[(ids[None, :, None] == exclude[q][:, None, :]).any(-1)] = -np.inf
+            k = min(topn, len(ids))
+            top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+            cand_ids[q, r, :k] = ids[top]
+            cand_scores[q, r, :k] = np.take_along_axis(score, top, axis=1)
+        cand_ids, cand_scores = cand_ids.reshape(len(queries), -1), cand_scores.reshape(len(queries), -1)
+        order = np.argsort(-cand_scores, axis=1, kind='stable')[:, :topn]
+        ids, scores = np.take_along_axis(cand_ids, order, axis=1), np.take_along_axis(cand_scores, order, axis=1)
+        ids[np.isneginf(scores)] = -1
+        return ids, scores
+
+
+def get_ann_index(model_name: str, model, restrict_vocab: int = None, **kwargs):
+    """ IVF index of a model from `get_word_embedding_model`, built on the first call and persisted next to the native
+    cache of the model. It is rebuilt when the native cache or the parameters have changed.
+
+    :param model_name: name of the model
+    :param model: the model
+    :param restrict_vocab: index only the most frequent words of the vocabulary
+    :param kwargs: parameters of `IVFIndex.build`
+    """
+    model = getattr(model, 'wv', model)
+    path = '{}/{}.ivf{}'.format(NATIVE_CACHE_DIR, model_name, '' if restrict_vocab is None else '.' + str(restrict_vocab))
+    native_cache = '{}/{}.kv'.format(NATIVE_CACHE_DIR, model_name)
+    info = {'source': source_stamp(native_cache) if os.path.exists(native_cache) else None,
+            'params': {k: str(v) for k, v in kwargs.items()}}
+    if os.path.exists('{}/meta.json'.format(path)):
+        with open('{}/meta.json'.format(path), 'r') as f:
+            if json.load(f)['info'] == info:
+                return IVFIndex.load(path)
+        logging.info('index of {} is outdated, rebuilding'.format(model_name))
+        os.remove('{}/meta.json'.format(path))
+    logging.info('building ann index of {}: {}'.format(model_name, path))
+    IVFIndex.build(model.vectors[:restrict_vocab], **kwargs).save(path, info)
+    return IVFIndex.load(path)
@@ -0,0 +1,39 @@
+""" Vocabulary of the benchmark datasets, to load only the embeddings the benchmarks use """
+import os
+from functools import lru_cache
+
+from pair_store import pair_key
+
+
+@lru_cache(maxsize=None)
+def get_benchmark_vocab(cache_dir: str = './cache'):
+    """ Words and word pairs of the analogy test and the lexical relation datasets, including the pair vocabulary
+    (`vocab.txt`) shipped with them
+
+    :return: (words, pairs) as frozensets
+    """
+    from analogy_test import get_analogy_data
+    from lexical_relation import get_lexical_relation_data
+    pairs = set()
+    for val, test in get_analogy_data().values():
+        for o in val + test:
+            pairs.update(tuple(p) for p in [o['stem']] + o['choice'])
+    for data in get_lexical_relation_data().values():
+        for split, v in data.items():
+            if split != 'label':
+                pairs.update(tuple(p) for p in v['x'])
+    for name in ['analogy_test_dataset', 'lexical_relation_dataset']:
+        path = '{}/{}/vocab.txt'.format(cache_dir, name)
+        if os.path.exists(path):
+            with open(path) as f:
+                pairs.update(tuple(x.split('\t')[:2]) for x in f.read().split('\n') if len(x))
+    return frozenset(w for p in pairs for w in p), frozenset(pairs)
+
+
+def get_model_vocab(model_name: str):
+    """ Vocabulary of a model to cover the benchmarks: the words for word embedding models, and the keys of the pairs in
+    both directions for pair embedding models (`pair2vec` and `relative_init.*`) """
+    words, pairs = get_benchmark_vocab()
+    if model_name == 'pair2vec' or model_name.startswith('relative_init'):
+        return frozenset(k for a, b in pairs for k in [pair_key(a, b), pair_key(b, a)])
+    return words
@@ -7,42 +7,151 @@ import os
 import json
 import pickle
 import argparse
+from collections import Counter
+from functools import lru_cache
 from itertools import groupby
+from multiprocessing import Pool, Value
+from multiprocessing import TimeoutError as PoolTimeoutError
 from typing import Dict
 from tqdm import tqdm
 
-from gensim.models import KeyedVectors
-from util import wget, get_word_embedding_model
+import numpy as np
+from util import wget, get_word_embedding_model, get_embedding_matrix, Word2VecBinaryWriter
+from context_store import (
+    ContextStore, ContextStoreWriter, ContextAggregator, merge_vocab, remap_rows, iter_pair_blocks)
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
 # Corpus
 URL_CORPUS = 'https://drive.google.com/u/0/uc?id=17EBy4GD4tXl9G4NTjuIuG5ET7wfG4-xa&export=download'
 PATH_CORPUS = './cache/wikipedia_en_preprocessed.txt'
-CORPUS_LINE_LEN = 104000000  # 53709029
-if not os.path.exists(PATH_CORPUS):
-    logging.info('downloading wikidump')
-    wget(url=URL_CORPUS, cache_dir='./cache', gdrive_filename='wikipedia_en_preprocessed.zip')
 OVERWRITE_CACHE = False
 
-# Stopwords
-with open('./stopwords_en.txt', 'r') as f:
-    STOPWORD_LIST = list(set(list(filter(len, f.read().split('\n')))))
 
+def download_corpus():
+    if not os.path.exists(PATH_CORPUS):
+        logging.info('downloading wikidump')
+        wget(url=URL_CORPUS, cache_dir='./cache', gdrive_filename='wikipedia_en_preprocessed.zip')
 
-def get_wiki_vocab(minimum_frequency: int, word_vocabulary_size: int = None):
-    """ Get word distribution over Wikidump (lowercased and tokenized) """
-    dict_freq = {}
-    bar = tqdm(total=CORPUS_LINE_LEN)
-    with open(PATH_CORPUS, 'r', encoding='utf-8') as corpus_file:
+
+@lru_cache(maxsize=None)
+def get_stopwords():
+    with open('./stopwords_en.txt', 'r') as f:
+        return frozenset(filter(len, f.read().split('\n')))
+
+
+def get_corpus_shards(n_shards: int, path: str = PATH_CORPUS):
+    """ Split the corpus into byte ranges [start, end) aligned to line boundaries """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for n in range(1, n_shards):
+            f.seek(max(size * n // n_shards, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+# state of the worker processes, set by `_init_worker`
+_WORKER_CONTEXT = {}
+
+
+def _init_worker(progress, context):
+    _WORKER_CONTEXT.clear()
+    _WORKER_CONTEXT.update(context)
+    _WORKER_CONTEXT['progress'] = progress
+
+
+def iter_corpus(start: int = 0, end: int = None, path: str = PATH_CORPUS):
+    """ Iterate over the lines starting in the byte range [start, end) of the corpus """
+    progress = _WORKER_CONTEXT.get('progress')
+    with open(path, 'rb') as corpus_file:
+        corpus_file.seek(start)
+        position = reported = start
         for _line in corpus_file:
-            bar.update()
-            tokens = _line.strip().split(" ")
-            for token in tokens:
-                if token in STOPWORD_LIST or "__" in token or token.isdigit():
-                    continue
-                # token = token.replace('_', ' ')  # wiki dump do this preprocessing
-                dict_freq[token] = dict_freq[token] + 1 if token in dict_freq else 1
+            if end is not None and position >= end:
+                break
+            position += len(_line)
+            # report the bytes read to the parent process every few MB
+            if progress is not None and position - reported > 1 << 22:
+                with progress.get_lock():
+                    progress.value += position - reported
+                reported = position
+            yield _line.decode('utf-8')
+    if progress is not None:
+        with progress.get_lock():
+            progress.value += position - reported
+
+
+def _apply_shard(args):
+    """ `function(shard_index, start, end)` of `iter_corpus_shards` with the index of the shard """
+    function, shard_index, start, end = args
+    return shard_index, function(shard_index, start, end)
+
+
+def iter_corpus_shards(function, processes: int = 1, context: Dict = None):
+    """ Apply `function(shard_index, start, end)` over byte-range shards of the corpus with a pool of workers,
+    printing the progress in bytes per second across all shards
+
+    :param function: module level function, which can access `context` via `_WORKER_CONTEXT`
+    :param processes: number of worker processes (all cores if None)
+    :return: an iterator of (shard_index, output) in the order the shards complete, so that the caller can reduce the
+        outputs as they arrive instead of holding all of them
+    """
+    download_corpus()
+    processes = processes or os.cpu_count()
+    context = context or {}
+    if processes == 1:
+        _init_worker(None, context)
+        yield 0, function(0, 0, None)
+        return
+    # a few shards per worker to balance the load
+    shards = [(function, n, start, end) for n, (start, end) in enumerate(get_corpus_shards(processes * 4))]
+    progress = Value('q', 0)
+    bar = tqdm(total=os.path.getsize(PATH_CORPUS), unit='B', unit_scale=True)
+    with Pool(processes, initializer=_init_worker, initargs=(progress, context)) as pool:
+        result = pool.imap_unordered(_apply_shard, shards)
+        for _ in range(len(shards)):
+            while True:
+                try:
+                    output = result.next(1)
+                    break
+                except PoolTimeoutError:
+                    bar.update(progress.value - bar.n)
+            bar.update(progress.value - bar.n)
+            yield output
+        bar.close()
+
+
+def map_corpus_shards(function, processes: int = 1, context: Dict = None):
+    """ `iter_corpus_shards` collected into a list of the function outputs in the order of shards """
+    return [output for _, output in sorted(iter_corpus_shards(function, processes, context), key=lambda x: x[0])]
+
+
+def _count_vocab(shard_index: int, start: int, end: int):
+    """ Word frequency over a shard of the corpus """
+    stopwords = get_stopwords()
+    dict_freq = Counter()
+    for _line in iter_corpus(start, end):
+        tokens = _line.strip().split(" ")
+        # token = token.replace('_', ' ')  # wiki dump do this preprocessing
+        dict_freq.update(t for t in tokens if not (t in stopwords or "__" in t or t.isdigit()))
+    return dict_freq
+
+
+def get_wiki_vocab(minimum_frequency: int, word_vocabulary_size: int = None, processes: int = 1):
+    """ Get word distribution over Wikidump (lowercased and tokenized)
+
+    :param processes: number of worker processes counting shards of the corpus in parallel (all cores if None)
+    """
+    # load stopwords before the workers are forked
+    get_stopwords()
+    # merge the counters of the shards as they complete, so that only one of them is held besides the running total
+    dict_freq = Counter()
+    for _, partial_freq in iter_corpus_shards(_count_vocab, processes):
+        dict_freq.update(partial_freq)
+        del partial_freq
 
     # frequency filter
     dict_freq = sorted(dict_freq.items(), key=lambda x: x[0])
@@ -59,130 +168,125 @@ def get_wiki_vocab(minimum_frequency: int, word_vocabulary_size: int = None):
     return list(dict_freq.keys())
 
 
-def frequency_filtering(vocab_corpus, dict_pairvocab, window_size, cache_jsonline):
-
-    def get_context(i, tokens):
-        """ get context with token `i` in `tokens`, returns list of tuple (token_j, [w_1, ...])"""
-        try:
-            # `dict_pairvocab` construct multi words with halfspace while wiki dump with '_', so here to fix
-            # the mismatch
-            tmp_vocab = dict_pairvocab[tokens[i].replace('_', ' ')]
-        except KeyError:
-            return None
-
-        context_i_ = [(tokens[j], list(filter(lambda x: len(x) > 1, tokens[i + 1:j]))) for j in
-                      range(i + 2, min(i + 1 + window_size, len(tokens))) if tokens[j].replace('_', ' ') in tmp_vocab]
-        context_i_ = [(k_, v_) for k_, v_ in context_i_ if len(v_) > 1]
-        if len(context_i_) == 0:
-            return None
-        context_i_ = sorted(context_i_)
-        return dict([(k_, list(g)[0][1]) for k_, g in groupby(context_i_, key=lambda x: x[0])])
-
+def get_context(i, tokens, dict_pairvocab, window_size):
+    """ get context with token `i` in `tokens`, returns list of tuple (token_j, [w_1, ...])"""
+    try:
+        # `dict_pairvocab` construct multi words with halfspace while wiki dump with '_', so here to fix
+        # the mismatch
+        tmp_vocab = dict_pairvocab[tokens[i].replace('_', ' ')]
+    except KeyError:
+        return None
+
+    context_i_ = [(tokens[j], list(filter(lambda x: len(x) > 1, tokens[i + 1:j]))) for j in
+                  range(i + 2, min(i + 1 + window_size, len(tokens))) if tokens[j].replace('_', ' ') in tmp_vocab]
+    context_i_ = [(k_, v_) for k_, v_ in context_i_ if len(v_) > 1]
+    if len(context_i_) == 0:
+        return None
+    context_i_ = sorted(context_i_)
+    return dict([(k_, list(g)[0][1]) for k_, g in groupby(context_i_, key=lambda x: x[0])])
+
+
+def _extract_context(shard_index: int, start: int, end: int):
+    """ Write the (head, tail, context, count) tuples of pairs found in a shard of the corpus to a store of the shard,
+    keeping context words in the corpus vocabulary """
+    dict_pairvocab = _WORKER_CONTEXT['dict_pairvocab']
+    window_size = _WORKER_CONTEXT['window_size']
+    vocab_corpus = _WORKER_CONTEXT['vocab_corpus']
+    path = '{}/shard_{:05d}'.format(_WORKER_CONTEXT['cache_dir'], shard_index)
+    with ContextStoreWriter(path, compress=_WORKER_CONTEXT['compress']) as writer:
+        for sentence in iter_corpus(start, end):
+            token_list = sentence.strip().split(" ")
+            contexts = [(token_list[i_], get_context(i_, token_list, dict_pairvocab, window_size))
+                        for i_ in range(len(token_list))]
+            contexts = dict(filter(lambda x: x[1] is not None, contexts))
+            for token_i_, context_i in contexts.items():
+                for k, v in context_i.items():
+                    for token, count in Counter(t for t in v if t in vocab_corpus).items():
+                        writer.add(token_i_, k, token, count)
+    return path
+
+
+def frequency_filtering(vocab_corpus, dict_pairvocab, window_size, output_path, minimum_frequency_context: int = 1,
+                        processes: int = 1, compress: bool = False, max_memory_mb: int = 4096):
+    """ Aggregate the context words of pairs over the corpus into a store of (head, tail, context, count) sorted by
+    (head, tail, context). Context words out of `vocab_corpus` are dropped while scanning the corpus, and tuples less
+    frequent than `minimum_frequency_context` while aggregating. Contexts of each shard are cached at
+    `{output_path}_cache`, and the aggregation runs within `max_memory_mb` by spilling to `{output_path}_runs`.
+    """
+    cache_dir = '{}_cache'.format(output_path)
+    cache_list = '{}/shards.json'.format(cache_dir)
     logging.info('cache context word')
-    if OVERWRITE_CACHE or not os.path.exists(cache_jsonline):
-        bar = tqdm(total=CORPUS_LINE_LEN)
-        with open(cache_jsonline, 'w') as f_jsonline:
-            with open(PATH_CORPUS, 'r', encoding='utf-8') as corpus_file:
-                for sentence in corpus_file:
-                    bar.update()
-                    token_list = sentence.strip().split(" ")
-                    contexts = [(token_list[i_], get_context(i_, token_list)) for i_ in range(len(token_list))]
-                    contexts = dict(filter(lambda x: x[1] is not None, contexts))
-                    if len(contexts) > 0:
-                        f_jsonline.write(json.dumps(contexts) + '\n')
+    if OVERWRITE_CACHE or not os.path.exists(cache_list):
+        os.makedirs(cache_dir, exist_ok=True)
+        shard_paths = map_corpus_shards(
+            _extract_context, processes,
+            {'dict_pairvocab': dict_pairvocab, 'window_size': window_size, 'cache_dir': cache_dir,
+             'compress': compress, 'vocab_corpus': frozenset(vocab_corpus)})
+        with open(cache_list, 'w') as f:
+            json.dump(shard_paths, f)
 
     logging.info('aggregate over cache')
-    if not os.path.exists(cache_jsonline.replace('.jsonl', '_org.json')):
-        context_word_dict = {}
-        bar = tqdm(total=CORPUS_LINE_LEN)
-        with open(cache_jsonline, 'r') as f_jsonline:
-            for contexts in f_jsonline:
-                bar.update()
-                contexts = json.loads(contexts)
-                for token_i_, context_i in contexts.items():
-
-                    try:
-                        context_word_dict[token_i_]
-                    except KeyError:
-                        context_word_dict[token_i_] = {}
-
-                    for k, v in context_i.items():
-                        try:
-                            context_word_dict[token_i_][k]
-                        except KeyError:
-                            context_word_dict[token_i_][k] = {}
-
-                        for token in v:
-
-                            try:
-                                context_word_dict[token_i_][k][token] += 1
-                            except KeyError:
-                                context_word_dict[token_i_][k][token] = 1
-
-        with open(cache_jsonline.replace('.jsonl', '_org.json'), 'w') as f_json:
-            json.dump(context_word_dict, f_json)
-    else:
-        with open(cache_jsonline.replace('.jsonl', '_org.json'), 'r') as f_json:
-            context_word_dict = json.load(f_json)
-
-    logging.info('filtering vocab')
-    vocab_corpus = set(vocab_corpus)
-
-    def filter_vocab(_dict):
-        new_key = set(_dict.keys()).intersection(vocab_corpus)
-        _new_dict = {__k: _dict[__k] for __k in new_key}
-        return _new_dict
-
-    logging.info('filtering vocab 1st')
-    context_word_dict = {k: {k_: filter_vocab(v_) for k_, v_ in v.items()} for k, v in context_word_dict.items()}
-    logging.info('filtering vocab 2nd')
-    context_word_dict = {k: {k_: v_ for k_, v_ in v.items() if len(v_) > 0} for k, v in context_word_dict.items()}
-    logging.info('filtering vocab 3rd')
-    context_word_dict = {k: v for k, v in context_word_dict.items() if len(v) > 0}
-
-    return context_word_dict
+    info = {'minimum_frequency_context': minimum_frequency_context}
+    if not ContextStore.exists(output_path) or ContextStore(output_path).meta['info'] != info:
+        with open(cache_list, 'r') as f:
+            stores = [ContextStore(path) for path in json.load(f)]
+        vocab, lookups = merge_vocab(stores)
+        aggregator = ContextAggregator('{}_runs'.format(output_path), max_memory_mb)
+        for store, lookup in tqdm(list(zip(stores, lookups))):
+            for chunk in store.chunks():
+                aggregator.add_rows(remap_rows(chunk, lookup))
+        with ContextStoreWriter(output_path, vocab, compress=compress, info=info) as writer:
+            for rows in aggregator.merge(minimum_frequency_context):
+                writer.add_rows(rows)
+    return ContextStore(output_path)
 
 
 def get_relative_init(output_path: str,
-                      context_word_dict: Dict,
-                      minimum_frequency_context: int,
-                      word_embedding_type: str = 'fasttext'):
-    """ Get RELATIVE vectors """
+                      pairs_context: ContextStore,
+                      word_embedding_type: str = 'fasttext',
+                      block_size: int = 1 << 16):
+    """ Get RELATIVE vectors: average of the context word vectors of each pair weighted by their frequency, computed as
+    a product of the sparse pair x context frequency matrix and the context word embeddings for each block of pairs
+
+    :param block_size: maximum number of pairs of a block, which bounds the dense (pair, dim) output of the product
+    """
+    from scipy.sparse import csr_matrix
     logging.info("loading embeddings")
     word_embedding_model = get_word_embedding_model(word_embedding_type)
 
-    line_count = 0
-    with open(output_path + '.tmp', 'w', encoding='utf-8') as txt_file:
-        for token_i, tokens_paired in tqdm(context_word_dict.items()):
-            for token_j in tokens_paired:
-                vector_pair = 0
-                cont_pair = 0
-                for token_co in context_word_dict[token_i][token_j]:
-                    freq = context_word_dict[token_i][token_j][token_co]
-                    if freq < minimum_frequency_context:
-                        continue
-                    try:
-                        tmp = token_co.replace('_', ' ')
-                        token_co_vector = word_embedding_model[tmp]
-                        vector_pair += (freq * token_co_vector)
-                        cont_pair += 1
-                    except Exception:
-                        pass
-                if cont_pair != 0:
-                    vector_pair = vector_pair/cont_pair
-                    txt_file.write('__'.join([token_i, token_j]))
-                    for y in vector_pair:
-                        txt_file.write(' ' + str(y))
-                    txt_file.write("\n")
-                    line_count += 1
-
-    logging.info("reformat file to add header")
-    logging.info("\t * {} lines, {} dim".format(line_count, word_embedding_model.vector_size))
-    with open(output_path, 'w') as f_out:
-        f_out.write(str(line_count) + " " + str(word_embedding_model.vector_size) + "\n")
-        with open(output_path + '.tmp', 'r') as f_cache:
-            for line in f_cache:
-                f_out.write(line)
+    logging.info("map context words to embeddings")
+    used = np.zeros(len(pairs_context.vocab), dtype=bool)
+    for chunk in pairs_context.chunks():
+        used[chunk[:, 2]] = True
+    context_ids = np.flatnonzero(used)
+    context_vectors, found = get_embedding_matrix(
+        [pairs_context.vocab[i].replace('_', ' ') for i in context_ids], word_embedding_model)
+    context_vectors = context_vectors[found]
+    # row of each context word in `context_vectors`, -1 for the words without embedding
+    context_row = np.full(len(pairs_context.vocab), -1, dtype=np.int64)
+    context_row[context_ids[found]] = np.arange(len(context_vectors))
+
+    with Word2VecBinaryWriter(output_path, word_embedding_model.vector_size) as writer:
+        for chunk in tqdm(iter_pair_blocks(pairs_context)):
+            chunk_start = np.flatnonzero(np.concatenate([[True], (chunk[1:, :2] != chunk[:-1, :2]).any(1)]))
+            # a chunk of the store may hold millions of pairs, so split it into blocks of at most `block_size` pairs
+            for block in range(0, len(chunk_start), block_size):
+                end = chunk_start[block + block_size] if block + block_size < len(chunk_start) else len(chunk)
+                rows = chunk[chunk_start[block]:end]
+                start = chunk_start[block:block + block_size] - chunk_start[block]
+                pair_index = np.repeat(np.arange(len(start)), np.diff(np.append(start, len(rows))))
+                column = context_row[rows[:, 2]]
+                keep = column >= 0
+                matrix = csr_matrix(
+                    (rows[keep, 3].astype(np.float32), (pair_index[keep], column[keep])),
+                    shape=(len(start), len(context_vectors)))
+                cont_pair = np.diff(matrix.indptr).astype(np.float32)
+                pair_found = np.flatnonzero(cont_pair)
+                vector_pair = matrix[pair_found].dot(context_vectors) / cont_pair[pair_found, None]
+                writer.write(
+                    ['__'.join([pairs_context.vocab[rows[start[n], 0]], pairs_context.vocab[rows[start[n], 1]]])
+                     for n in pair_found], vector_pair)
+    logging.info("\t * {} lines, {} dim".format(writer.count, writer.vector_size))
 
 
 def get_options():
@@ -197,6 +301,11 @@ def get_options():
                              'calculations and reduce memory but we would recommend keeping this number low')
     # The following parameters are needed if pair vocabulary is not provided
     parser.add_argument('--minimum-frequency', help='Minimum frequency of words', type=int, default=5)
+    parser.add_argument('--processes', help='Number of worker processes (all cores by default)', type=int,
+                        default=None)
+    parser.add_argument('--compress', help='Compress the chunks of intermediate pair context stores',
+                        action='store_true')
+    parser.add_argument('--max-memory', help='Memory budget (MB) to aggregate pair contexts', type=int, default=4096)
     return parser.parse_args()
 
 
@@ -222,42 +331,32 @@ if __name__ == '__main__':
         with open(cache, 'rb') as fb:
             vocab = pickle.load(fb)
     else:
-        vocab = get_wiki_vocab(minimum_frequency=opt.minimum_frequency)
+        vocab = get_wiki_vocab(minimum_frequency=opt.minimum_frequency, processes=opt.processes)
         with open(cache, 'wb') as fb:
             pickle.dump(vocab, fb)
 
     logging.info("\t * filtering corpus by frequency")
-    cache = '{}/pairs_context.json'.format(opt.output_dir)
-    if os.path.exists(cache):
-        with open(cache, 'r') as f:
-            pairs_context = json.load(f)
-    else:
-        logging.info("retrieve pair and word vocabulary (dictionary)")
-        pair_vocab = sorted(pair_vocab)
-        grouper = groupby(pair_vocab, key=lambda x: x[0])
-        pair_vocab_dict = {k: list(set(list(map(lambda x: x[1], g)))) for k, g in grouper}
-        pairs_context = frequency_filtering(
-            vocab,
-            pair_vocab_dict,
-            opt.window_size,
-            cache_jsonline='{}/pairs_context_cache.jsonl'.format(opt.output_dir))
-        with open(cache, 'w') as f:
-            json.dump(pairs_context, f)
-
-    cache = '{}/relative_init.{}.txt'.format(opt.output_dir, opt.model)
+    cache = '{}/pairs_context'.format(opt.output_dir)
+    logging.info("retrieve pair and word vocabulary (dictionary)")
+    pair_vocab = sorted(pair_vocab)
+    grouper = groupby(pair_vocab, key=lambda x: x[0])
+    pair_vocab_dict = {k: set(map(lambda x: x[1], g)) for k, g in grouper}
+    pairs_context = frequency_filtering(
+        vocab,
+        pair_vocab_dict,
+        opt.window_size,
+        output_path=cache,
+        minimum_frequency_context=opt.minimum_frequency_context,
+        processes=opt.processes,
+        compress=opt.compress,
+        max_memory_mb=opt.max_memory)
+
+    cache = '{}/relative_init.{}.bin'.format(opt.output_dir, opt.model)
 
     logging.info("\t * computing relative-init vectors: {}".format(cache))
     if not os.path.exists(cache):
         get_relative_init(
             output_path=cache,
-            context_word_dict=pairs_context,
-            minimum_frequency_context=opt.minimum_frequency_context,
+            pairs_context=pairs_context,
             word_embedding_type=opt.model)
-
-    logging.info("producing binary file")
-    cache_bin = cache.replace('.txt', '.bin')
-    if not os.path.exists(cache_bin):
-        model = KeyedVectors.load_word2vec_format(cache)
-        model.wv.save_word2vec_format(cache_bin, binary=True)
-        logging.info("new embeddings are available at {}".format(cache_bin))
-        os.remove(cache)
+        logging.info("new embeddings are available at {}".format(cache))
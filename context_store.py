@@ -0,0 +1,285 @@
+""" Columnar store of the (head, tail, context, count) tuples of word pairs co-occurring over the corpus
+- a store is a directory of the token table (`vocab.txt`), fixed-width uint32 chunks of rows in the column order of
+  `COLUMNS` (`chunk_*.npy`, or zlib compressed `chunk_*.npy.z`) and `meta.json`, which is written at last to mark the
+  store as complete
+- tokens are kept as integer id to the token table, and uncompressed chunks are read as read-only memory map
+"""
+import os
+import io
+import json
+import zlib
+import shutil
+from typing import Dict
+
+import numpy as np
+
+COLUMNS = ('head', 'tail', 'context', 'count')
+DTYPE = np.uint32
+
+
+class ContextStoreWriter:
+    """ Write rows of a store in chunks """
+
+    def __init__(self, path: str, vocab=None, chunk_size: int = 1 << 22, compress: bool = False, info: Dict = None,
+                 pending_size: int = 1 << 16):
+        """ Write rows of a store in chunks
+
+        :param path: directory of the store, overwritten if exists
+        :param vocab: initial token table
+        :param chunk_size: number of rows in a chunk
+        :param compress: compress each chunk with zlib
+        :param info: parameters the store is built with, kept in the meta data
+        :param pending_size: number of rows added by `add` kept as python tuples before they are moved into a uint32
+            array, which is a small fraction of the size of the tuples
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path = path
+        self.vocab = list(vocab) if vocab is not None else []
+        self.token_ids = {t: n for n, t in enumerate(self.vocab)}
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.info = info or {}
+        self.chunks = []
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending = []
+        self.pending_size = pending_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def token_id(self, token: str):
+        """ id of the token, added to the token table if it is new """
+        try:
+            return self.token_ids[token]
+        except KeyError:
+            self.token_ids[token] = len(self.vocab)
+            self.vocab.append(token)
+            return self.token_ids[token]
+
+    def add(self, head: str, tail: str, context: str, count: int = 1):
+        """ add a row given by tokens """
+        self.pending.append((self.token_id(head), self.token_id(tail), self.token_id(context), count))
+        self.buffer_size += 1
+        if self.buffer_size >= self.chunk_size:
+            self.flush()
+        elif len(self.pending) >= self.pending_size:
+            self._stack_pending()
+
+    def add_rows(self, rows):
+        """ add an array of rows, which holds ids of the token table """
+        if len(rows) == 0:
+            return
+        self._stack_pending()
+        self.buffer.append(np.asarray(rows, dtype=DTYPE))
+        self.buffer_size += len(rows)
+        if self.buffer_size >= self.chunk_size:
+            self.flush()
+
+    def _stack_pending(self):
+        if len(self.pending):
+            self.buffer.append(np.array(self.pending, dtype=DTYPE))
+            self.pending = []
+
+    def flush(self):
+        if self.buffer_size == 0:
+            return
+        self._stack_pending()
+        rows = np.concatenate(self.buffer)
+        self.buffer, self.buffer_size = [], 0
+        for start in range(0, len(rows), self.chunk_size):
+            self._write_chunk(rows[start:start + self.chunk_size])
+
+    def _write_chunk(self, rows):
+        filename = 'chunk_{:05d}.npy'.format(len(self.chunks))
+        if self.compress:
+            filename += '.z'
+            buffer = io.BytesIO()
+            np.save(buffer, rows)
+            with open('{}/{}'.format(self.path, filename), 'wb') as f:
+                f.write(zlib.compress(buffer.getvalue()))
+        else:
+            np.save('{}/{}'.format(self.path, filename), rows)
+        self.chunks.append({'file': filename, 'rows': len(rows)})
+
+    def close(self):
+        self.flush()
+        with open('{}/vocab.txt'.format(self.path), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.vocab))
+        with open('{}/meta.json'.format(self.path), 'w') as f:
+            json.dump({'columns': COLUMNS, 'dtype': np.dtype(DTYPE).name, 'vocab_size': len(self.vocab),
+                       'chunks': self.chunks, 'info': self.info}, f)
+
+
+class ContextStore:
+    """ Read a store written by `ContextStoreWriter` """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open('{}/meta.json'.format(path), 'r') as f:
+            self.meta = json.load(f)
+        with open('{}/vocab.txt'.format(path), 'r', encoding='utf-8') as f:
+            self.vocab = f.read().split('\n') if self.meta['vocab_size'] > 0 else []
+        assert len(self.vocab) == self.meta['vocab_size'], 'broken token table: {}'.format(path)
+
+    @staticmethod
+    def exists(path: str):
+        return os.path.exists('{}/meta.json'.format(path))
+
+    def __len__(self):
+        return sum(c['rows'] for c in self.meta['chunks'])
+
+    def _load_chunk(self, chunk):
+        path = '{}/{}'.format(self.path, chunk['file'])
+        if path.endswith('.z'):
+            with open(path, 'rb') as f:
+                return np.load(io.BytesIO(zlib.decompress(f.read())))
+        return np.load(path, mmap_mode='r')
+
+    def chunks(self):
+        """ iterate over chunks of rows, memory-mapped unless compressed """
+        for chunk in self.meta['chunks']:
+            yield self._load_chunk(chunk)
+
+    def to_array(self):
+        """ all the rows as a single array, without copy if the store has one uncompressed chunk """
+        chunks = list(self.chunks())
+        if len(chunks) == 0:
+            return np.zeros((0, len(COLUMNS)), dtype=DTYPE)
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks)
+
+
+def merge_vocab(stores):
+    """ Sorted union of the token tables of `stores`, and the lookup array from the ids of each store to the union """
+    vocab = sorted(set().union(*[s.vocab for s in stores]))
+    token_ids = {t: n for n, t in enumerate(vocab)}
+    lookups = [np.array([token_ids[t] for t in s.vocab], dtype=DTYPE) for s in stores]
+    return vocab, lookups
+
+
+def remap_rows(rows, lookup):
+    """ map token ids of rows with a lookup array """
+    rows = np.array(rows, dtype=DTYPE)
+    rows[:, :3] = lookup[rows[:, :3]]
+    return rows
+
+
+def reduce_rows(rows):
+    """ sort rows by (head, tail, context) and sum up the count of duplicated tuples """
+    if len(rows) == 0:
+        return np.zeros((0, len(COLUMNS)), dtype=DTYPE)
+    rows = rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 0]))]
+    start = np.flatnonzero(np.concatenate([[True], (rows[1:, :3] != rows[:-1, :3]).any(1)]))
+    reduced = rows[start]
+    reduced[:, 3] = np.add.reduceat(rows[:, 3], start)
+    return reduced
+
+
+def _count_not_greater(rows, key):
+    """ number of rows not greater than `key` in (head, tail, context) order, given rows sorted in the order """
+    h, t, c = (rows[:, i].astype(np.int64) for i in range(3))
+    k_h, k_t, k_c = key
+    return int(((h < k_h) | ((h == k_h) & ((t < k_t) | ((t == k_t) & (c <= k_c))))).sum())
+
+
+class ContextAggregator:
+    """ Sum up the counts of (head, tail, context) tuples within a bounded memory
+    - rows are accumulated in a fixed-size table, which is compacted by sorting and summing up duplicated tuples
+      when it is full, and spilled to disk as a sorted run when compaction does not free enough space
+    - `merge` combines the runs by k-way merge, reading a block of each run at once
+    """
+
+    def __init__(self, run_dir: str, max_memory_mb: int = 4096):
+        """ Sum up the counts of (head, tail, context) tuples within a bounded memory
+
+        :param run_dir: directory to spill sorted runs, removed after `merge`
+        :param max_memory_mb: memory budget, which bounds the size of the table and the blocks read by `merge`
+        """
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir)
+        self.run_dir = run_dir
+        # compaction of the table takes several times of its size for the sorted copy and the sort index
+        self.capacity = max(max_memory_mb * 1024 ** 2 // (np.dtype(DTYPE).itemsize * len(COLUMNS) * 4), 1024)
+        self.table = np.empty((self.capacity, len(COLUMNS)), dtype=DTYPE)
+        self.size = 0
+        self.runs = []
+
+    def add_rows(self, rows):
+        """ add an array of rows """
+        while len(rows):
+            n = min(self.capacity - self.size, len(rows))
+            self.table[self.size:self.size + n] = rows[:n]
+            self.size += n
+            rows = rows[n:]
+            if self.size == self.capacity:
+                self._compact()
+
+    def _compact(self):
+        reduced = reduce_rows(self.table[:self.size])
+        if len(reduced) > self.capacity // 2:
+            self._spill(reduced)
+            self.size = 0
+        else:
+            self.table[:len(reduced)] = reduced
+            self.size = len(reduced)
+
+    def _spill(self, rows):
+        path = '{}/run_{:05d}.npy'.format(self.run_dir, len(self.runs))
+        np.save(path, rows)
+        self.runs.append(path)
+
+    def merge(self, minimum_count: int = 1):
+        """ iterate over the aggregated rows sorted by (head, tail, context) in blocks
+
+        :param minimum_count: drop tuples whose total count is less than this
+        """
+        runs = [np.load(path, mmap_mode='r') for path in self.runs]
+        runs.append(reduce_rows(self.table[:self.size]))
+        self.table = None
+        block_size = max(self.capacity // len(runs), 1)
+        position = [0] * len(runs)
+        while True:
+            active = [n for n, run in enumerate(runs) if position[n] < len(run)]
+            if len(active) == 0:
+                break
+            blocks = {n: runs[n][position[n]:position[n] + block_size] for n in active}
+            # every row up to the smallest last key among blocks, which do not reach the end of their run, is in the
+            # current blocks, since each run has no duplicated tuples
+            unfinished = [tuple(blocks[n][-1, :3].tolist()) for n in active if position[n] + block_size < len(runs[n])]
+            if unfinished:
+                bound = min(unfinished)
+                size = {n: _count_not_greater(blocks[n], bound) for n in active}
+            else:
+                size = {n: len(blocks[n]) for n in active}
+            rows = np.concatenate([blocks[n][:size[n]] for n in active])
+            for n in active:
+                position[n] += size[n]
+            rows = reduce_rows(rows)
+            yield rows[rows[:, 3] >= minimum_count]
+        del runs
+        shutil.rmtree(self.run_dir)
+
+
+def iter_pair_blocks(store: ContextStore):
+    """ iterate over blocks of rows of a store sorted by (head, tail), each of which holds every row of its pairs """
+    rest = None
+    for chunk in store.chunks():
+        if rest is not None:
+            chunk = np.concatenate([rest, chunk])
+        change = np.flatnonzero((chunk[1:, :2] != chunk[:-1, :2]).any(1)) + 1
+        if len(change) == 0:
+            rest = chunk
+            continue
+        yield chunk[:change[-1]]
+        rest = chunk[change[-1]:]
+    if rest is not None and len(rest):
+        yield rest
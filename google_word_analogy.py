@@ -1,21 +1,175 @@
 """ Google analogy test benchmark with word embedding model """
+import os
 import logging
 from random import seed
-from gensim.test.utils import datapath
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from util import get_word_embedding_model
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 seed(1)
 
 
-def test_analogy(model_type):
+class AnalogySolver:
+    """ Open-vocabulary analogy solver over the unit-normalized embedding matrix, which scores batches of questions
+    against blocks of the vocabulary by matrix multiplication in a thread pool and keeps the top-k of each block """
+
+    def __init__(self, model, restrict_vocab: int = 300000, dtype=np.float32, block_size: int = 16384,
+                 batch_size: int = 1024, threads: int = None, index=None, nprobe: int = 16):
+        """ Open-vocabulary analogy solver
+
+        :param model: gensim KeyedVectors
+        :param restrict_vocab: search only the most frequent words of the vocabulary, as gensim
+        :param dtype: dtype to keep the normalized matrix (np.float16 halves the memory), scores are in float32
+        :param block_size: number of words of a vocabulary block
+        :param batch_size: number of questions scored at once
+        :param threads: number of threads to score vocabulary blocks
+        :param index: `ann_index.IVFIndex` over the restricted vocabulary to search approximately in place of the exact
+            search (3CosAdd only), which holds the normalized vectors instead of the solver
+        :param nprobe: number of the lists of `index` to scan
+        """
+        model = getattr(model, 'wv', model)
+        self.words = model.index2word[:restrict_vocab]
+        # case-insensitive vocabulary, where the most frequent word among the case variants stands for them as gensim
+        self.ok_vocab = {w.upper(): n for n, w in reversed(list(enumerate(self.words)))}
+        self.index = index
+        self.nprobe = nprobe
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.threads = threads or os.cpu_count()
+        if index is not None:
+            assert len(index) == len(self.words), 'index size {} != vocabulary size {}'.format(
+                len(index), len(self.words))
+            self.vectors = None
+            return
+        self.vectors = np.empty((len(self.words), model.vector_size), dtype=dtype)
+        for start in range(0, len(self.words), block_size):
+            block = np.asarray(model.vectors[start:min(start + block_size, len(self.words))], dtype=np.float32)
+            norm = np.sqrt((block * block).sum(-1, keepdims=True))
+            self.vectors[start:start + block_size] = block / np.where(norm > 0, norm, 1)
+
+    def _vector(self, ids):
+        if self.index is not None:
+            return self.index.vector(ids)
+        return np.asarray(self.vectors[ids], dtype=np.float32)
+
+    def _block_top(self, query, exclude, start: int, topn: int, method: str):
+        """ top-k of a vocabulary block for a batch of queries, with the indices of `exclude` masked out """
+        block = np.asarray(self.vectors[start:start + self.block_size], dtype=np.float32)
+        if method == '3cosadd':
+            score = np.matmul(query, block.T)
+        else:
+            # query holds (a, b, c) in the first axis
+            cos = (1 + np.matmul(query, block.T)) / 2
+            score = cos[1] * cos[2] / (cos[0] + 1e-6)
+        rows, cols = np.nonzero((exclude >= start) & (exclude < start + len(block)))
+        score[rows, exclude[rows, cols] - start] = -np.inf
+        # select the entries not less than the k-th largest score of each row, which is much faster than argpartition
+        # over the whole block, then keep the k largest of them per row
+        k = min(topn, len(block))
+        kth = np.partition(score, len(block) - k, axis=1)[:, len(block) - k]
+        rows, cols = np.nonzero(score >= kth[:, None])
+        values = score[rows, cols]
+        order = np.lexsort((-values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        keep = np.arange(len(rows)) - np.searchsorted(rows, np.arange(len(score)))[rows] < k
+        return cols[keep].reshape(-1, k) + start, values[keep].reshape(-1, k)
+
+    def most_similar(self, positive, negative, topn: int = 5, method: str = '3cosadd'):
+        """ Indices of the `topn` words for `b - a + c` of each question, excluding a, b and c themselves
+
+        :param positive: int array (question, 2) of the indices of b and c
+        :param negative: int array (question,) of the index of a
+        :param method: `3cosadd` (gensim `most_similar`) or `3cosmul` (gensim `most_similar_cosmul`)
+        :return: int array (question, topn) sorted by the score
+        """
+        assert method in ['3cosadd', '3cosmul'], 'unknown method: {}'.format(method)
+        assert self.index is None or method == '3cosadd', 'approximate search supports only 3cosadd'
+        exclude = np.concatenate([np.asarray(negative).reshape(-1, 1), np.asarray(positive)], axis=1)
+        result = np.zeros((len(exclude), topn), dtype=np.int64)
+        with ThreadPoolExecutor(self.threads) as executor:
+            for q_start in range(0, len(exclude), self.batch_size):
+                q_exclude = exclude[q_start:q_start + self.batch_size]
+                a, b, c = (self._vector(q_exclude[:, i]) for i in range(3))
+                if method == '3cosadd':
+                    query = (b + c - a) / 3
+                    norm = np.sqrt((query * query).sum(-1, keepdims=True))
+                    query /= np.where(norm > 0, norm, 1)
+                    if self.index is not None:
+                        result[q_start:q_start + len(q_exclude)] = self.index.search(
+                            query, topn, self.nprobe, exclude=q_exclude)[0]
+                        continue
+                else:
+                    query = np.stack([a, b, c])
+                tops = list(executor.map(
+                    lambda start: self._block_top(query, q_exclude, start, topn, method),
+                    range(0, len(self.vectors), self.block_size)))
+                index = np.concatenate([t[0] for t in tops], axis=1)
+                score = np.concatenate([t[1] for t in tops], axis=1)
+                order = np.argsort(-score, axis=1, kind='stable')[:, :topn]
+                result[q_start:q_start + len(q_exclude)] = np.take_along_axis(index, order, axis=1)
+        return result
+
+    def evaluate_word_analogies(self, analogies: str, method: str = '3cosadd'):
+        """ Accuracy on an analogy file in the format of `questions-words.txt`, following gensim
+        `evaluate_word_analogies` (case-insensitive, questions with a word out of the vocabulary are skipped, and the
+        top-5 word which is none of the question words is the prediction)
+
+        :return: (accuracy, sections) where each section is a dictionary of `section`, `correct` and `incorrect`
+        """
+        sections = []
+        questions = []
+        with open(analogies, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith(': '):
+                    sections.append({'section': line.lstrip(': ').strip(), 'correct': [], 'incorrect': []})
+                    continue
+                assert len(sections), 'missing section header: {}'.format(analogies)
+                words = [w.upper() for w in line.split()]
+                if len(words) != 4:
+                    continue
+                if all(w in self.ok_vocab for w in words):
+                    questions.append((sections[-1], words))
+        logging.info('{} questions in vocabulary'.format(len(questions)))
+        index = np.array([[self.ok_vocab[w] for w in words[:3]] for _, words in questions], dtype=np.int64)
+        top = self.most_similar(index[:, 1:], index[:, 0], topn=5, method=method) if len(questions) else []
+        for (section, (a, b, c, expected)), candidates in zip(questions, top):
+            predicted = None
+            for n in candidates[candidates >= 0]:
+                predicted = self.words[n].upper()
+                if predicted not in [a, b, c]:
+                    break
+            section['correct' if predicted == expected else 'incorrect'].append((a, b, c, expected))
+        correct = sum(len(s['correct']) for s in sections)
+        incorrect = sum(len(s['incorrect']) for s in sections)
+        return correct / (correct + incorrect) if correct + incorrect else 0.0, sections
+
+
+def test_analogy(model_type, solver: str = 'blocked', nprobe: int = 16, **kwargs):
+    """ Google analogy test
+
+    :param model_type: word embedding model
+    :param solver: `blocked` to use `AnalogySolver`, `ann` to use it with the approximate search by
+        `ann_index.get_ann_index`, or `gensim` to use gensim `evaluate_word_analogies`
+    :param nprobe: number of the lists to scan by the approximate search
+    :param kwargs: parameters of `AnalogySolver`
+    """
+    from gensim.test.utils import datapath
     model = get_word_embedding_model(model_type)
-    analogy_result = model.evaluate_word_analogies(datapath('questions-words.txt'))
+    if solver == 'gensim':
+        analogy_result = model.evaluate_word_analogies(datapath('questions-words.txt'))
+    else:
+        if solver == 'ann':
+            from ann_index import get_ann_index
+            kwargs['index'] = get_ann_index(model_type, model, kwargs.get('restrict_vocab', 300000))
+            kwargs['nprobe'] = nprobe
+        analogy_result = AnalogySolver(model, **kwargs).evaluate_word_analogies(datapath('questions-words.txt'))
     return {'model_type': model_type, 'accuracy': analogy_result[0]}
 
 
 if __name__ == '__main__':
+    import pandas as pd
     out_fasttext = test_analogy('fasttext')
     out_glove = test_analogy('glove')
     out_w2v = test_analogy('w2v')
@@ -25,4 +179,3 @@ if __name__ == '__main__':
     out = pd.DataFrame(full_result)
     logging.info('finish evaluation:\n{}'.format(out))
     out.to_csv('./results/google_word_analogy.csv')
-
@@ -1,19 +1,22 @@
 import os
+import json
 import logging
+import shutil
+import tempfile
 from glob import glob
+from copy import deepcopy
 import tqdm
 from itertools import product
+from collections import OrderedDict
 from multiprocessing import Pool
 
-import pandas as pd
 import numpy as np
 
-from sklearn.metrics import f1_score
-from sklearn.neural_network import MLPClassifier
-
-from util import get_word_embedding_model, wget
+from util import MODEL_REGISTRY, wget, get_embedding_matrix
+from pair_store import PairStore, pair_key, get_pair_store
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
-pbar = tqdm.tqdm()
+# progress bar of the grid search, created on the first use
+pbar = None
 
 
 def get_lexical_relation_data():
@@ -76,8 +79,58 @@ def diff(a, b, model, add_feature='concat', pair_models=None, bi_direction: bool
     return np.concatenate(feature)
 
 
+def build_features(x, model, add_feature='concat', pair_models=None, bi_direction: bool = True):
+    """ Batched version of `diff`, which builds the features of every pair at once
+
+    :param x: a list of word pairs
+    :return: (feature, oov) where `feature` is a float32 matrix with zero rows for pairs `diff` returns None and `oov`
+        is the boolean mask of those rows
+    """
+    words = {}
+    index = np.array([[words.setdefault(w, len(words)) for w in pair] for pair in x], dtype=np.int64).reshape(-1, 2)
+    vectors, found = get_embedding_matrix(list(words), model)
+    oov = ~found[index].all(-1)
+    pair_models = [m for m in pair_models or [] if m is not None]
+
+    word_blocks = (['a', 'b'] if 'concat' in add_feature else []) + \
+                  (['diff'] if 'diff' in add_feature else []) + (['dot'] if 'dot' in add_feature else [])
+    directions = [False, True] if bi_direction else [False]
+    dim = len(word_blocks) * vectors.shape[1] + sum(getattr(m, 'wv', m).vector_size for m in pair_models) * \
+        len(directions)
+    feature = np.zeros((len(x), dim), dtype=np.float32)
+
+    valid = np.flatnonzero(~oov)
+    vec_a, vec_b = vectors[index[valid, 0]], vectors[index[valid, 1]]
+    start = 0
+    for block in word_blocks:
+        end = start + vectors.shape[1]
+        if block == 'a':
+            feature[valid, start:end] = vec_a
+        elif block == 'b':
+            feature[valid, start:end] = vec_b
+        elif block == 'diff':
+            feature[valid, start:end] = vec_a - vec_b
+        else:
+            feature[valid, start:end] = vec_a * vec_b
+        start = end
+    # pairs missing in a pair model keep the zero block
+    valid_x = [x[n] for n in valid]
+    for pair_model in pair_models:
+        if isinstance(pair_model, PairStore):
+            pair_features = pair_model.lookup(valid_x, bi_direction)
+        else:
+            pair_features = [get_embedding_matrix([pair_key(b, a) if reverse else pair_key(a, b) for a, b in valid_x],
+                                                  pair_model) for reverse in directions]
+        for vec_r, _ in pair_features:
+            end = start + vec_r.shape[1]
+            feature[valid, start:end] = vec_r
+            start = end
+    return feature, oov
+
+
 def run_test(clf, x, y):
     """ run evaluation on valid or test set """
+    from sklearn.metrics import f1_score
     y_pred = clf.predict(x)
     f_mac = f1_score(y, y_pred, average='macro')
     f_mic = f1_score(y, y_pred, average='micro')
@@ -85,10 +138,33 @@ def run_test(clf, x, y):
     return accuracy, f_mac, f_mic
 
 
+def save_dataset(dataset, path: str):
+    """ Save the feature matrix and label of each split as `.npy` files, which workers memory-map without copy
+
+    :param dataset: a dictionary of split name to (feature, label)
+    :param path: directory to save the files
+    :return: a dictionary of split name to the (feature, label) file paths
+    """
+    os.makedirs(path, exist_ok=True)
+    files = {}
+    for split, (x, y) in dataset.items():
+        files[split] = ('{}/{}.x.npy'.format(path, split), '{}/{}.y.npy'.format(path, split))
+        np.save(files[split][0], np.ascontiguousarray(x, dtype=np.float32))
+        np.save(files[split][1], np.asarray(y, dtype=np.int64))
+    return files
+
+
+def load_dataset(files):
+    """ Attach to the files of `save_dataset` as read-only memory map """
+    return {split: (np.load(x, mmap_mode='r'), np.load(y, mmap_mode='r')) for split, (x, y) in files.items()}
+
+
 class Evaluate:
 
-    def __init__(self, dataset, shared_config, default_config: bool = False):
-        self.dataset = dataset
+    def __init__(self, dataset_files, shared_config, default_config: bool = False):
+        """ Train and evaluate a classifier on a dataset saved by `save_dataset`, which is memory-mapped in each call,
+        so that only the file paths are sent to the workers """
+        self.dataset_files = dataset_files
         if default_config:
             self.configs = [{'random_state': 0}]
         else:
@@ -109,22 +185,32 @@ class Evaluate:
         return list(range(len(self.configs)))
 
     def __call__(self, config_id):
+        from sklearn.neural_network import MLPClassifier
+        global pbar
+        if pbar is None:
+            pbar = tqdm.tqdm()
         pbar.update(1)
         config = self.configs[config_id]
+        dataset = load_dataset(self.dataset_files)
         # train
-        x, y = self.dataset['train']
+        x, y = dataset['train']
         clf = MLPClassifier(**config).fit(x, y)
-        # test
-        x, y = self.dataset['test']
+        return self.get_report(config_id, clf, dataset)
+
+    def get_report(self, config_id, clf, dataset, n_iter: int = None):
+        """ report of a trained classifier on the test set, and the val set if any """
+        x, y = dataset['test']
         t_accuracy, t_f_mac, t_f_mic = run_test(clf, x, y)
         report = self.shared_config.copy()
+        report['config_id'] = config_id
         report.update(
             {'metric/test/accuracy': t_accuracy,
              'metric/test/f1_macro': t_f_mac,
              'metric/test/f1_micro': t_f_mic,
-             'classifier_config': clf.get_params()})
-        if 'val' in self.dataset:
-            x, y = self.dataset['val']
+             'classifier_config': clf.get_params(),
+             'n_iter': clf.n_iter_ if n_iter is None else n_iter})
+        if 'val' in dataset:
+            x, y = dataset['val']
             v_accuracy, v_f_mac, v_f_mic = run_test(clf, x, y)
             report.update(
                 {'metric/val/accuracy': v_accuracy,
@@ -132,92 +218,241 @@ class Evaluate:
                  'metric/val/f1_micro': v_f_mic})
         return report
 
+    def search(self, min_iter: int = 10, max_iter: int = 200, eta: int = 3, patience: int = 3):
+        """ Successive halving over the configs instead of training each of them to convergence. Every config is
+        trained by `partial_fit` for `min_iter` epochs, and only the top `1 / eta` configs by val F1 macro continue
+        with `eta` times larger budget, until one config is left. A config stops early when its val F1 macro, checked
+        every `min_iter` epochs, does not improve `patience` times in a row, and its best state on val is reported.
+
+        :param min_iter: epochs of the first round, and the interval to check val F1 macro
+        :param max_iter: maximum epochs of a config
+        :param eta: the fraction of the configs to continue is `1 / eta`
+        :param patience: number of the checks without improvement to stop a config
+        :return: list of the reports of every config
+        """
+        from sklearn.neural_network import MLPClassifier
+        from sklearn.metrics import f1_score
+        assert min_iter <= max_iter, 'min_iter should not exceed max_iter'
+        dataset = load_dataset(self.dataset_files)
+        x, y = dataset['train']
+        x_val, y_val = dataset['val']
+        classes = np.unique(y)
+        states = {i: {'clf': MLPClassifier(**self.configs[i]), 'n_iter': 0, 'best': None, 'best_f1': -1,
+                      'best_iter': 0, 'wait': 0, 'stop': False} for i in self.config_indices}
+
+        def train(state, epochs):
+            for _ in range(epochs // min_iter):
+                if state['stop']:
+                    return
+                for _ in range(min_iter):
+                    state['clf'].partial_fit(x, y, classes=classes)
+                state['n_iter'] += min_iter
+                f1 = f1_score(y_val, state['clf'].predict(x_val), average='macro')
+                if f1 > state['best_f1']:
+                    state['best_f1'], state['best'], state['best_iter'] = f1, deepcopy(state['clf']), state['n_iter']
+                    state['wait'] = 0
+                else:
+                    state['wait'] += 1
+                state['stop'] = state['wait'] >= patience or state['n_iter'] >= max_iter
+
+        alive, budget = self.config_indices, min_iter
+        while True:
+            for i in alive:
+                train(states[i], min(budget, max_iter - states[i]['n_iter']))
+            if len(alive) == 1:
+                # the last config is trained until it stops
+                train(states[alive[0]], max_iter - states[alive[0]]['n_iter'])
+                break
+            alive = sorted(alive, key=lambda i: -states[i]['best_f1'])[:int(np.ceil(len(alive) / eta))]
+            budget *= eta
+        return [self.get_report(i, states[i]['best'], dataset, states[i]['best_iter']) for i in self.config_indices]
+
+
+def expand_grid(target_word_embedding, pattern):
+    """ (model, feature, add_relative, add_pair2vec) of the experiment, where pair embeddings are added only to the
+    features with `dot` """
+    grid = []
+    for m in target_word_embedding:
+        for _feature in pattern:
+            grid.append((m, _feature, False, False))
+            if _feature in [('diff', 'dot'), ('concat', 'dot')]:
+                grid.append((m, _feature, True, False))
+                grid.append((m, _feature, False, True))
+    return grid
+
+
+def job_key(report):
+    """ identify the job of a report by (model, feature, add_relative, add_pair2vec, data, search, config_id) """
+    return (report['model'], str(report['feature']), bool(report['add_relative']), bool(report['add_pair2vec']),
+            report['data'], report.get('search', 'grid'), report['config_id'])
 
-def evaluate(embedding_model: str = None, feature='concat', add_relative: bool = False, add_pair2vec: bool = False):
-    model = get_word_embedding_model(embedding_model)
-    model_pair = []
-    if add_relative:
-        model_pair.append(get_word_embedding_model('relative_init.{}'.format(embedding_model)))
-    if add_pair2vec:
-        model_pair.append(get_word_embedding_model('pair2vec'))
 
+def load_checkpoint(path: str):
+    """ reports appended to a jsonl checkpoint by `run_grid` """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        reports = [json.loads(line) for line in f.read().split('\n') if len(line) > 0]
+    for r in reports:
+        r['feature'] = tuple(r['feature']) if type(r['feature']) is list else r['feature']
+    return reports
+
+
+def _json_default(o):
+    return o.item() if isinstance(o, np.generic) else str(o)
+
+
+def _search_pending(evaluator, pending):
+    return [r for r in evaluator.search() if r['config_id'] in pending]
+
+
+def run_grid(grid, checkpoint: str = None, processes: int = None, search: str = 'grid', subset: bool = False):
+    """ Run every (dataset, config) job of the grid on a single worker pool. Jobs are submitted grouped by the word
+    embedding model, so that each embedding is loaded once, and features of each dataset are built once and shared with
+    the workers by memory-mapped files.
+
+    :param grid: list of (model, feature, add_relative, add_pair2vec), see `expand_grid`
+    :param checkpoint: jsonl file to append each report as soon as its job finishes, jobs found in it are skipped
+    :param processes: number of the workers
+    :param search: `grid` to train every config to convergence as a job, or `halving` to run `Evaluate.search` over
+        the configs of each dataset as a job (datasets without val split have the default config only either way)
+    :param subset: load only the words of the benchmark datasets from the word embedding models
+    :return: list of the reports of the jobs run in this call
+    """
+    done = set(job_key(r) for r in load_checkpoint(checkpoint)) if checkpoint else set()
     data = get_lexical_relation_data()
+    os.makedirs('cache', exist_ok=True)
+    f_checkpoint = None
+    if checkpoint:
+        if os.path.dirname(checkpoint):
+            os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+        f_checkpoint = open(checkpoint, 'a')
+
+    assert search in ['grid', 'halving'], 'unknown search: {}'.format(search)
+
+    def write_report(report):
+        if f_checkpoint is not None:
+            f_checkpoint.write(json.dumps(report, default=_json_default) + '\n')
+            f_checkpoint.flush()
+
+    def write_reports(reports):
+        for r in reports:
+            write_report(r)
+
     report = []
-    for data_name, v in data.items():
-        logging.info('train model with {} on {}'.format(embedding_model, data_name))
-        label_dict = v.pop('label')
-        # preprocess data
-        oov = {}
-        dataset = {}
-        for _k, _v in v.items():
-            x = [diff(a, b, model, feature, model_pair) for (a, b) in _v['x']]
-            dim = len([_x for _x in x if _x is not None][0])
-            # initialize zero vector for OOV
-            dataset[_k] = [
-                [_x if _x is not None else np.zeros(dim) for _x in x],
-                _v['y']]
-            oov[_k] = sum([_x is None for _x in x])
-        shared_config = {
-            'model': embedding_model, 'feature': feature, 'add_relative': add_relative,
-            'add_pair2vec': add_pair2vec, 'label_size': len(label_dict), 'data': data_name,
-            'oov': oov
-        }
-
-        # grid serach
-        if 'val' not in dataset:
-            evaluator = Evaluate(dataset, shared_config, default_config=True)
-            tmp_report = evaluator(0)
-        else:
-            pool = Pool()
-            evaluator = Evaluate(dataset, shared_config)
-            tmp_report = pool.map(evaluator, evaluator.config_indices)
-            pool.close()
-        tmp_report = [tmp_report] if type(tmp_report) is not list else tmp_report
-        report += tmp_report
-        # print(report)
-        # print(pd.DataFrame(report))
-        # input()
-    del model
-    del model_pair
+    pool = Pool(processes)
+    try:
+        for embedding_model in list(OrderedDict.fromkeys(m for m, _, _, _ in grid)):
+            results = []
+            feature_dirs = []
+            model = None
+            for _, feature, add_relative, add_pair2vec in filter(lambda x: x[0] == embedding_model, grid):
+                model_pair = None
+                for data_name, v in data.items():
+                    label_dict = v['label']
+                    splits = {_k: _v for _k, _v in v.items() if _k != 'label'}
+                    shared_config = {
+                        'model': embedding_model, 'feature': feature, 'add_relative': add_relative,
+                        'add_pair2vec': add_pair2vec, 'label_size': len(label_dict), 'data': data_name,
+                        'search': search
+                    }
+                    evaluator = Evaluate(None, shared_config, default_config='val' not in splits)
+                    pending = [i for i in evaluator.config_indices
+                               if job_key(dict(shared_config, config_id=i)) not in done]
+                    if len(pending) == 0:
+                        continue
+                    if model is None:
+                        model = MODEL_REGISTRY.get(embedding_model, subset=subset)
+                    if model_pair is None:
+                        model_pair = []
+                        if add_relative:
+                            model_pair.append(get_pair_store('relative_init.{}'.format(embedding_model)))
+                        if add_pair2vec:
+                            model_pair.append(get_pair_store('pair2vec'))
+                    logging.info('train model with {} ({}) on {}: {} jobs'.format(
+                        embedding_model, feature, data_name, len(pending)))
+                    # preprocess data, saved in memory-mapped files to be shared with the workers
+                    feature_dir = tempfile.mkdtemp(prefix='lexical_relation_feature.', dir='cache')
+                    feature_dirs.append(feature_dir)
+                    oov = {}
+                    dataset = {}
+                    for _k, _v in splits.items():
+                        x, x_oov = build_features(_v['x'], model, feature, model_pair)
+                        dataset.update(save_dataset({_k: [x, _v['y']]}, feature_dir))
+                        oov[_k] = int(x_oov.sum())
+                        del x
+                    evaluator.shared_config['oov'] = oov
+                    evaluator.dataset_files = dataset
+                    if search == 'halving' and len(evaluator.config_indices) > 1:
+                        # configs are searched together, and the whole search is run again if any of them is missing
+                        results.append(pool.apply_async(
+                            _search_pending, (evaluator, pending), callback=write_reports))
+                    else:
+                        results += [pool.apply_async(evaluator, (i,), callback=write_report) for i in pending]
+            # wait for the jobs of the model before moving on and removing its features
+            for r in results:
+                r = r.get()
+                report += r if type(r) is list else [r]
+            for feature_dir in feature_dirs:
+                shutil.rmtree(feature_dir)
+            del model
+    finally:
+        pool.close()
+        pool.join()
+        if f_checkpoint is not None:
+            f_checkpoint.close()
     return report
 
 
+def select_best(df, previous=None):
+    """ Row of the best val F1 macro of each (model, feature, data, add_relative, add_pair2vec) group, or its first row
+    when the group has no val F1 macro, in a single sort over the rows
+
+    :param df: pandas DataFrame of the reports
+    :param previous: the output of `select_best` over the former reports, to update it incrementally with new reports
+        `df` instead of selecting over all the reports again
+    """
+    import pandas as pd
+    if previous is not None:
+        df = pd.concat([previous, df]) if len(df) > 0 else previous
+    df = df.reset_index(drop=True)
+    if len(df) == 0:
+        return df
+    # keys are compared as string, to match the reports loaded from csv
+    keys = df[['model', 'feature', 'data', 'add_relative', 'add_pair2vec']].astype(str)
+    if 'metric/val/f1_macro' in df.columns:
+        score = df['metric/val/f1_macro'].astype(float).fillna(-np.inf).values
+    else:
+        score = np.full(len(df), -np.inf)
+    order = np.argsort(-score, kind='stable')
+    best = order[~keys.iloc[order].duplicated().values]
+    return df.iloc[np.sort(best)]
+
+
+def evaluate(embedding_model: str = None, feature='concat', add_relative: bool = False, add_pair2vec: bool = False):
+    return run_grid([(embedding_model, feature, add_relative, add_pair2vec)])
+
+
 if __name__ == '__main__':
+    import pandas as pd
     # model_name = os.getenv('MODEL', 'w2v')
     # print(model_name)
     # target_word_embedding = [model_name]
     target_word_embedding = ['w2v', 'fasttext', 'glove']
-    done_list = []
-    full_result = []
-    export = 'results/lexical_relation_all.csv'
-    if os.path.exists(export):
-        df = pd.read_csv(export, index_col=0)
-        done_list = df[['model', 'feature']].values.tolist()
-        full_result = [i.to_dict() for _, i in df.iterrows()]
-    logging.info("RUN WORD-EMBEDDING BASELINE")
     pattern = ['diff', 'concat', ('diff', 'dot'), ('concat', 'dot')]
-    for m in target_word_embedding:
-        for _feature in pattern:
-            if [m, str(_feature)] in done_list:
-                continue
-            full_result += evaluate(m, feature=_feature)
-            if _feature in [('diff', 'dot'), ('concat', 'dot')]:
-                full_result += evaluate(m, feature=_feature, add_relative=True)
-                full_result += evaluate(m, feature=_feature, add_pair2vec=True)
-            pd.DataFrame(full_result).to_csv(export)
+    # `SEARCH=halving` runs successive halving over the classifier configs in place of the full grid search
+    search_mode = os.getenv('SEARCH', 'grid')
+    suffix = '' if search_mode == 'grid' else '.{}'.format(search_mode)
+    checkpoint = 'results/lexical_relation_all{}.jsonl'.format(suffix)
+    export = 'results/lexical_relation_all{}.csv'.format(suffix)
+    logging.info("RUN WORD-EMBEDDING BASELINE")
+    run_grid(expand_grid(target_word_embedding, pattern), checkpoint=checkpoint, search=search_mode, subset=True)
+    full_result = load_checkpoint(checkpoint)
+    pd.DataFrame(full_result).to_csv(export)
+    logging.info('model registry: {}'.format(MODEL_REGISTRY.stats()))
     # aggregate result
     # export = 'results/lexical_relation.{}.csv'.format(model_name)
-    export = 'results/lexical_relation.csv'
-    out = []
-    df = pd.DataFrame(full_result)
-    for _m in df.model.unique():
-        for _f in df.feature.unique():
-            for _d in df.data.unique():
-                for _r in df.add_relative.unique():
-                    for _p in df.add_pair2vec.unique():
-                        df_tmp = df[df.model == _m][df.feature == _f][df.data == _d][df.add_relative
-                                                                                     == _r][df.add_pair2vec == _p]
-                        df_tmp = df_tmp.sort_values(by=['metric/val/f1_macro'], ascending=False)
-                        out.append(df_tmp.head(1))
-    pd.concat(out).to_csv(export)
-
+    export = 'results/lexical_relation{}.csv'.format(suffix)
+    # select over every report of the checkpoint, which includes the jobs of interrupted runs that have never been
+    # exported
+    select_best(pd.DataFrame(full_result)).to_csv(export)
@@ -0,0 +1,148 @@
+""" Memory-mapped store of pair embeddings (RELATIVE, pair2vec) for batched lookup by word pairs
+- a store is a directory of the sorted 64-bit blake2b hashes of the normalized pair keys (`hashes.npy`), the vectors
+  in the same order (`vectors.npy`), the keys themselves (`keys.bin` and `key_offsets.npy`) to resolve hash collision,
+  and `meta.json`, which is written at last to mark the store as complete
+- word pairs are normalized into keys by `pair_key` only at lookup, as the keys of the models are already normalized,
+  and every file is memory-mapped read-only, so that a lookup only touches the pages of the pairs it needs
+"""
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+from util import NATIVE_CACHE_DIR, source_stamp, get_word_embedding_model
+
+
+def pair_key(a: str, b: str):
+    """ key of a word pair in the pair embedding models """
+    return '__'.join([a, b]).lower().replace(' ', '_')
+
+
+def _hash(key: str):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class PairStore:
+    """ Read a store written by `PairStore.build` """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open('{}/meta.json'.format(path), 'r') as f:
+            self.meta = json.load(f)
+        self.vector_size = self.meta['vector_size']
+        self.hashes = np.load('{}/hashes.npy'.format(path), mmap_mode='r')
+        self.vectors = np.load('{}/vectors.npy'.format(path), mmap_mode='r')
+        self.key_offsets = np.load('{}/key_offsets.npy'.format(path), mmap_mode='r')
+        self.keys = np.memmap('{}/keys.bin'.format(path), dtype=np.uint8, mode='r') \
+            if self.key_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def exists(path: str):
+        return os.path.exists('{}/meta.json'.format(path))
+
+    @staticmethod
+    def build(model, path: str, info=None, chunk_size: int = 1 << 16):
+        """ Build a store from a pair embedding model
+
+        :param model: gensim KeyedVectors of which keys are given by `pair_key`
+        :param path: directory of the store
+        :param info: parameters the store is built with, kept in the meta data
+        :param chunk_size: number of vectors copied at once
+        """
+        model = getattr(model, 'wv', model)
+        os.makedirs(path, exist_ok=True)
+        if PairStore.exists(path):
+            os.remove('{}/meta.json'.format(path))
+        keys = model.index2word
+        hashes = np.array([_hash(k) for k in keys], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        np.save('{}/hashes.npy'.format(path), hashes[order])
+        vectors = np.lib.format.open_memmap(
+            '{}/vectors.npy'.format(path), mode='w+', dtype=np.float32, shape=(len(keys), model.vector_size))
+        key_offsets = np.zeros(len(keys) + 1, dtype=np.uint64)
+        with open('{}/keys.bin'.format(path), 'wb') as f:
+            for start in range(0, len(keys), chunk_size):
+                chunk = order[start:start + chunk_size]
+                # read the rows of the model in ascending order
+                unique, inverse = np.unique(chunk, return_inverse=True)
+                vectors[start:start + len(chunk)] = np.asarray(model.vectors[unique], dtype=np.float32)[inverse]
+                encoded = [keys[i].encode('utf-8') for i in chunk]
+                key_offsets[start + 1:start + len(chunk) + 1] = np.cumsum([len(k) for k in encoded]) + \
+                    key_offsets[start]
+                f.write(b''.join(encoded))
+        vectors.flush()
+        del vectors
+        np.save('{}/key_offsets.npy'.format(path), key_offsets)
+        with open('{}/meta.json'.format(path), 'w') as f:
+            json.dump({'size': len(keys), 'vector_size': model.vector_size, 'info': info or {}}, f)
+        return PairStore(path)
+
+    def _key(self, position: int):
+        return self.keys[self.key_offsets[position]:self.key_offsets[position + 1]].tobytes().decode('utf-8')
+
+    def get_embedding_matrix(self, keys):
+        """ Stack the vectors of normalized `keys` into a float32 matrix, with zero rows for keys missing in the store
+
+        :return: (matrix, found) where `found` is a boolean mask of the keys in the store
+        """
+        hashes = np.array([_hash(k) for k in keys], dtype=np.uint64)
+        position = np.searchsorted(self.hashes, hashes)
+        position = np.minimum(position, max(len(self) - 1, 0))
+        found = (self.hashes[position] == hashes) if len(self) else np.zeros(len(keys), dtype=bool)
+        # confirm the key of each hit, and look for the colliding keys next to it
+        for n in np.flatnonzero(found):
+            p = position[n]
+            while p < len(self) and self.hashes[p] == hashes[n] and self._key(p) != keys[n]:
+                p += 1
+            found[n] = p < len(self) and self.hashes[p] == hashes[n]
+            position[n] = p
+        matrix = np.zeros((len(keys), self.vector_size), dtype=np.float32)
+        if found.any():
+            unique, inverse = np.unique(position[found], return_inverse=True)
+            matrix[found] = self.vectors[unique][inverse]
+        return matrix, found
+
+    def lookup(self, pairs, bi_direction: bool = False):
+        """ Batched lookup of word pairs
+
+        :param pairs: a list of (head, tail) word pairs
+        :param bi_direction: look up the reverse pairs too
+        :return: a list of (matrix, found) of `get_embedding_matrix` for the pairs, and the reverse pairs if
+            `bi_direction`
+        """
+        keys = [pair_key(a, b) for a, b in pairs]
+        if not bi_direction:
+            return [self.get_embedding_matrix(keys)]
+        matrix, found = self.get_embedding_matrix(keys + [pair_key(b, a) for a, b in pairs])
+        return [(matrix[:len(keys)], found[:len(keys)]), (matrix[len(keys):], found[len(keys):])]
+
+
+def _source_path(model_name: str):
+    """ source file of a pair embedding model in `get_word_embedding_model` """
+    if model_name == 'pair2vec':
+        return './cache/pair2vec.fasttext.bin'
+    return './cache/{}.bin'.format(model_name)
+
+
+def get_pair_store(model_name: str):
+    """ Pair store of a pair embedding model of `get_word_embedding_model`, built from the model on the first call and
+    persisted next to its native cache. It is rebuilt when the source file of the model has changed, and kept if the
+    source file has been removed.
+
+    :param model_name: name of the pair embedding model such as `relative_init.fasttext` or `pair2vec`
+    """
+    path = '{}/{}.pairs'.format(NATIVE_CACHE_DIR, model_name)
+    source = _source_path(model_name)
+    if PairStore.exists(path):
+        store = PairStore(path)
+        if not os.path.exists(source) or store.meta['info'].get('source') == source_stamp(source):
+            return store
+        logging.info('source of {} has changed, rebuilding pair store'.format(model_name))
+    logging.info('building pair store of {}: {}'.format(model_name, path))
+    # the model is downloaded if the source is missing, and its native cache is rebuilt if the source has changed
+    model = get_word_embedding_model(model_name)
+    return PairStore.build(model, path, {'source': source_stamp(source)})
@@ -0,0 +1,56 @@
+""" benchmark the approximate search of `ann_index` against the exact search of `google_word_analogy.AnalogySolver` on
+the Google analogy questions """
+import argparse
+import logging
+from time import time
+
+import numpy as np
+from util import get_word_embedding_model
+from ann_index import get_ann_index
+from google_word_analogy import AnalogySolver
+
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description='benchmark approximate nearest neighbour search for analogy')
+    parser.add_argument('--model', help='word embedding model', type=str, default="fasttext")
+    parser.add_argument('--restrict-vocab', help='size of the vocabulary to search', type=int, default=300000)
+    parser.add_argument('--n-list', help='number of the inverted lists', type=int, default=None)
+    parser.add_argument('--nprobe', help='numbers of the lists to scan', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--n-question', help='number of the questions to use', type=int, default=None)
+    return parser.parse_args()
+
+
+def load_questions(path, ok_vocab):
+    """ (a, b, c) index of the questions of which words are all in the vocabulary """
+    with open(path, 'r', encoding='utf-8') as f:
+        questions = [[w.upper() for w in line.split()] for line in f if not line.startswith(': ')]
+    return np.array([[ok_vocab[w] for w in q[:3]] for q in questions
+                     if len(q) == 4 and all(w in ok_vocab for w in q)], dtype=np.int64).reshape(-1, 3)
+
+
+if __name__ == '__main__':
+    from gensim.test.utils import datapath
+    import pandas as pd
+    opt = get_options()
+    model = get_word_embedding_model(opt.model)
+    exact = AnalogySolver(model, restrict_vocab=opt.restrict_vocab)
+    questions = load_questions(datapath('questions-words.txt'), exact.ok_vocab)[:opt.n_question]
+    logging.info('{} questions'.format(len(questions)))
+
+    start = time()
+    truth = exact.most_similar(questions[:, 1:], questions[:, 0], topn=1)[:, 0]
+    result = [{'search': 'exact', 'nprobe': None, 'recall@1': 1.0, 'time': time() - start}]
+    del exact
+
+    start = time()
+    index = get_ann_index(opt.model, model, opt.restrict_vocab, n_list=opt.n_list)
+    logging.info('index loaded in {:.1f} sec: {} lists'.format(time() - start, len(index.centroids)))
+    for nprobe in opt.nprobe:
+        solver = AnalogySolver(model, restrict_vocab=opt.restrict_vocab, index=index, nprobe=nprobe)
+        start = time()
+        pred = solver.most_similar(questions[:, 1:], questions[:, 0], topn=1)[:, 0]
+        result.append({'search': 'ivf', 'nprobe': nprobe, 'recall@1': float((pred == truth).mean()),
+                       'time': time() - start})
+    logging.info('\n{}'.format(pd.DataFrame(result)))
@@ -1,11 +1,9 @@
 """ generate `concat_relative_fasttext` embedding model """
 import argparse
-import os
 import logging
-import truecase
+import numpy as np
 from tqdm import tqdm
-from gensim.models import KeyedVectors
-from util import get_word_embedding_model
+from util import get_word_embedding_model, get_embedding_matrix, truecase_words, Word2VecBinaryWriter
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -16,13 +14,10 @@ def get_options():
                         type=str, default="./cache")
     parser.add_argument('--model', help='word embedding model', type=str, default="fasttext")
     parser.add_argument('--truecase', help='Truecasing', action='store_true')
+    parser.add_argument('--batch-size', help='Number of pairs computed at once', type=int, default=100000)
     return parser.parse_args()
 
 
-def tc(string):
-    return truecase.get_true_case('A ' + string)[2:]
-
-
 if __name__ == '__main__':
     opt = get_options()
 
@@ -37,34 +32,22 @@ if __name__ == '__main__':
     model = get_word_embedding_model(relative_model)
 
     logging.info("concat with word embedding model")
-    cache_concat = cache.replace('.txt', '.concat.txt')
-    cache_concat_bin = cache_concat.replace('.txt', '.bin')
-    if os.path.exists(cache_concat):
-        os.remove(cache_concat)
-
-    vocab_size = 0
-    with open(cache_concat + '.tmp', 'w') as f:
-        for v in tqdm(model.vocab):
-            a, b = v.split('__')
-            if opt.truecase:
-                a, b = tc(a), tc(b)
-            try:
-                v_diff = model_word[a] - model_word[b]
-                new_vector = list(model[v]) + list(v_diff)
-                f.write(v + ' ' + ' '.join([str(i) for i in new_vector]) + "\n")
-                vocab_size += 1
-            except Exception:
-                pass
-    with open(cache_concat, 'w') as f:
-        f.write(str(vocab_size) + " " + str(model.vector_size + model_word.vector_size) + "\n")
-        with open(cache_concat + '.tmp', 'r') as f_read:
-            for line in f_read:
-                f.write(line)
-
-    logging.info("producing binary file")
-    model = KeyedVectors.load_word2vec_format(cache_concat)
-    model.wv.save_word2vec_format(cache_concat_bin, binary=True)
+    pairs = [v.split('__') for v in model.index2word]
+    if opt.truecase:
+        tc = truecase_words(w for pair in pairs for w in pair)
+        pairs = [[tc[a], tc[b]] for a, b in pairs]
+    # resolve every word of the pairs to a row of `word_vectors` at once
+    words = {}
+    index = np.array([[words.setdefault(w, len(words)) for w in pair] for pair in pairs], dtype=np.int64)
+    word_vectors, found = get_embedding_matrix(list(words), model_word)
+    pair_found = found[index].all(1)
+    logging.info("\t * {} out of {} pairs are out of vocabulary of {}".format(
+        len(pairs) - pair_found.sum(), len(pairs), opt.model))
+
+    cache_concat_bin = cache.replace('.txt', '.concat.bin')
+    with Word2VecBinaryWriter(cache_concat_bin, model.vector_size + model_word.vector_size) as writer:
+        for start in tqdm(range(0, len(pairs), opt.batch_size)):
+            batch = np.flatnonzero(pair_found[start:start + opt.batch_size]) + start
+            v_diff = word_vectors[index[batch, 0]] - word_vectors[index[batch, 1]]
+            writer.write([model.index2word[i] for i in batch], np.concatenate([model.vectors[batch], v_diff], 1))
     logging.info("new embeddings are available at {}".format(cache_concat_bin))
-
-
-
@@ -4,10 +4,9 @@
 import os
 import pickle
 import logging
-import truecase
 
 from gensim.models import KeyedVectors
-from util import wget
+from util import wget, truecase_words
 
 
 def get_pair_relative(cache_dir: str = './cache'):
@@ -21,21 +20,18 @@ def get_pair_relative(cache_dir: str = './cache'):
 
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
-all_vocab = get_pair_relative()
-all_vocab = [v.split('__') for v in list(set(['__'.join(v) for v in all_vocab]))]
-logging.info('{} pairs'.format(len(all_vocab)))
 
-with open('./common_word_pairs.pkl', "wb") as fp:
-    pickle.dump(all_vocab, fp)
 
-logging.info('truecasing')
+if __name__ == '__main__':
+    all_vocab = get_pair_relative()
+    all_vocab = [v.split('__') for v in list(set(['__'.join(v) for v in all_vocab]))]
+    logging.info('{} pairs'.format(len(all_vocab)))
 
+    with open('./common_word_pairs.pkl', "wb") as fp:
+        pickle.dump(all_vocab, fp)
 
-def tc(string):
-    string = truecase.get_true_case('A ' + string)
-    return string[2:]
-
-
-all_vocab_tc = [[tc(v_) for v_ in v] for v in all_vocab]
-with open('./common_word_pairs_truecase.pkl', "wb") as fp:
-    pickle.dump(all_vocab_tc, fp)
+    logging.info('truecasing')
+    tc = truecase_words(v_ for v in all_vocab for v_ in v)
+    all_vocab_tc = [[tc[v_] for v_ in v] for v in all_vocab]
+    with open('./common_word_pairs_truecase.pkl', "wb") as fp:
+        pickle.dump(all_vocab_tc, fp)
@@ -2,32 +2,33 @@
 import logging
 import json
 
-from util import get_word_embedding_model
-from analogy_test import get_analogy_data, get_prediction_we
+from util import MODEL_REGISTRY
+from analogy_test import get_analogy_data, get_prediction_batch
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
-full_data = get_analogy_data()
-
 
 def cap(_list):
     return [t.capitalize() for t in _list]
 
 
 if __name__ == '__main__':
+    full_data = get_analogy_data()
     # full_data['bats_cap'] = full_data['bats']
     for i in ['bats_cap', 'bats', 'sat', 'u2', 'u4', 'google']:
         val, test = full_data[i]
         for data in [test, val]:
             for model_type in ['fasttext', 'glove', 'w2v']:
-                model = get_word_embedding_model(model_type)
+                model = MODEL_REGISTRY.get(model_type)
                 if i == 'bats_cap':
-                    _pred = [get_prediction_we(cap(o['stem']), [cap(m) for m in o['choice']], model, 'diff') for o in test]
+                    _data = [{'stem': cap(o['stem']), 'choice': [cap(m) for m in o['choice']]} for o in test]
+                    _pred = get_prediction_batch(_data, model, 'diff')
                 else:
-                    _pred = [get_prediction_we(o['stem'], o['choice'], model, 'diff') for o in data]
+                    _pred = get_prediction_batch(data, model, 'diff')
                 for d, p in zip(data, _pred):
                     d['pred/{}'.format(model_type)] = p
 
+    logging.info('model registry: {}'.format(MODEL_REGISTRY.stats()))
     with open('../results/analogy.prediction.json', 'w') as f:
         json.dump(full_data, f)
 
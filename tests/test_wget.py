@@ -0,0 +1,133 @@
+""" Tests of `util.wget` against a local HTTP server with range request support """
+import os
+import sys
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import wget
+
+# a few chunks of `util.CHUNK_SIZE`, so that an interrupted download keeps the chunks received before
+DATA = os.urandom(3 << 20)
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ serve `DATA` with an ETag, `Range` and `If-Range`, configured by the class attributes """
+    support_range = True
+    truncate = None
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Handler.requests.append(dict(self.headers))
+        start = 0
+        if self.support_range and 'Range' in self.headers and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(DATA)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.end_headers()
+        body = DATA[start:]
+        self.wfile.write(body if self.truncate is None else body[:self.truncate])
+
+
+@pytest.fixture
+def url():
+    Handler.support_range, Handler.truncate, Handler.requests = True, None, []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/data.bin'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def write_part(cache_dir, data, validator=ETAG):
+    with open('{}/data.bin.part'.format(cache_dir), 'wb') as f:
+        f.write(data)
+    if validator is not False:
+        with open('{}/data.bin.part.json'.format(cache_dir), 'w') as f:
+            json.dump({'validator': validator}, f)
+
+
+def read(cache_dir):
+    assert sorted(os.listdir(cache_dir)) == ['data.bin']
+    with open('{}/data.bin'.format(cache_dir), 'rb') as f:
+        return f.read()
+
+
+def test_download(url, tmp_path):
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+    assert 'Range' not in Handler.requests[0]
+
+
+def test_resume_interrupted(url, tmp_path):
+    Handler.truncate = len(DATA) // 2
+    with pytest.raises(Exception):
+        wget(url, str(tmp_path))
+    offset = os.path.getsize('{}/data.bin.part'.format(tmp_path))
+    assert 0 < offset < len(DATA)
+    Handler.truncate = None
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+    assert Handler.requests[-1]['Range'] == 'bytes={}-'.format(offset)
+    assert Handler.requests[-1]['If-Range'] == ETAG
+
+
+def test_part_of_older_version(url, tmp_path):
+    write_part(tmp_path, os.urandom(1000), validator='"v0"')
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+
+
+def test_part_without_validator(url, tmp_path):
+    write_part(tmp_path, DATA[:1000], validator=False)
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+    assert 'Range' not in Handler.requests[0]
+
+
+def test_complete_part(url, tmp_path):
+    write_part(tmp_path, DATA)
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+    assert len(Handler.requests) == 1
+
+
+def test_oversized_part(url, tmp_path):
+    write_part(tmp_path, DATA + os.urandom(7))
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+    assert len(Handler.requests) == 2
+
+
+def test_no_range_support(url, tmp_path):
+    Handler.support_range = False
+    write_part(tmp_path, DATA[:1000])
+    wget(url, str(tmp_path))
+    assert read(tmp_path) == DATA
+
+
+def test_checksum(url, tmp_path):
+    wget(url, str(tmp_path), checksum=hashlib.sha256(DATA).hexdigest())
+    assert read(tmp_path) == DATA
+    os.remove('{}/data.bin'.format(tmp_path))
+    with pytest.raises(ValueError):
+        wget(url, str(tmp_path), checksum='0' * 64)
+    assert os.listdir(str(tmp_path)) == []
@@ -2,16 +2,166 @@
 import tarfile
 import zipfile
 import gzip
-import requests
+import hashlib
+import shutil
+import tempfile
 import os
+import json
+import logging
+from collections import OrderedDict
+from multiprocessing import Pool
 
-import gdown
-from gensim.models import KeyedVectors
-from gensim.models import fasttext
+import numpy as np
 
 
-def get_word_embedding_model(model_name: str = 'fasttext'):
-    """ get word embedding model """
+NATIVE_CACHE_DIR = './cache/native'
+SUBSET_CACHE_DIR = './cache/native/subset'
+CHUNK_SIZE = 1 << 20
+
+
+def source_stamp(path: str):
+    """ identify the version of a source file by its size and modification time """
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _native_cache_path(model_name: str):
+    return '{}/{}.kv'.format(NATIVE_CACHE_DIR, model_name)
+
+
+def _is_cache_valid(cache_path: str, source_path: str):
+    """ whether a cache exists and its stamp matches the source """
+    stamp_path = '{}.stamp.json'.format(cache_path)
+    if not os.path.exists(cache_path) or not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path, 'r') as f:
+        return json.load(f) == source_stamp(source_path)
+
+
+def _save_cache(model, cache_path: str, source_path: str):
+    """ save a model in the native format with the stamp of the source, which is written at last """
+    # `sep_limit=0` stores every array as a separate `.npy`, so that all of them can be memory-mapped
+    model.save(cache_path, sep_limit=0)
+    stamp_path = '{}.stamp.json'.format(cache_path)
+    with open(stamp_path + '.tmp', 'w') as f:
+        json.dump(source_stamp(source_path), f)
+    os.replace(stamp_path + '.tmp', stamp_path)
+
+
+def load_native_cache(model_name: str, source_path: str, loader):
+    """ Load a model from the native cache (`.npy` vector matrices and a pickled vocab index), memory-mapped
+    read-only. The cache is (re)built from `source_path` with `loader` when missing or when the source has changed.
+
+    :param model_name: name of the model, used as the cache file name
+    :param source_path: original embedding file the cache is derived from
+    :param loader: function returning the model parsed from `source_path`
+    """
+    from gensim.models import KeyedVectors
+    os.makedirs(NATIVE_CACHE_DIR, exist_ok=True)
+    cache_path = _native_cache_path(model_name)
+    stamp_path = '{}.stamp.json'.format(cache_path)
+    if _is_cache_valid(cache_path, source_path):
+        return KeyedVectors.load(cache_path, mmap='r')
+    if os.path.exists(cache_path):
+        logging.info('source of {} has changed, rebuilding native cache'.format(model_name))
+    logging.info('building native cache for {}: {}'.format(model_name, cache_path))
+    # keep the stamp invalid until the new cache is complete
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    model = loader()
+    _save_cache(model.wv, cache_path, source_path)
+    del model
+    return KeyedVectors.load(cache_path, mmap='r')
+
+
+def _stream_word2vec(path: str, binary: bool, vocab):
+    """ Read the vectors of the words in `vocab` from a word2vec format file in a single pass, without parsing the
+    vectors of the other words. The first vector of a duplicated word is kept as gensim.
+
+    :return: (words, vectors) in the order of the file
+    """
+    words, vectors = [], []
+    found = set()
+    with open(path, 'rb') as f:
+        size, vector_size = map(int, f.readline().split())
+        if not binary:
+            for line in f:
+                parts = line.rstrip().decode('utf-8').split(' ')
+                if parts[0] in vocab and parts[0] not in found:
+                    found.add(parts[0])
+                    words.append(parts[0])
+                    vectors.append(np.array(parts[1:], dtype=np.float32))
+        else:
+            vector_bytes = vector_size * np.dtype(np.float32).itemsize
+            buffer, position = b'', 0
+            for _ in range(size):
+                end = buffer.find(b' ', position)
+                while end < 0 or len(buffer) - end - 1 < vector_bytes:
+                    chunk = f.read(CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        raise EOFError('unexpected end of {}'.format(path))
+                    buffer, position = buffer[position:] + chunk, 0
+                    end = buffer.find(b' ', position)
+                word = buffer[position:end].decode('utf-8').lstrip('\n')
+                if word in vocab and word not in found:
+                    found.add(word)
+                    words.append(word)
+                    # copy the row, as a view would keep the whole read buffer alive
+                    vectors.append(np.frombuffer(buffer, dtype=np.float32, count=vector_size, offset=end + 1).copy())
+                position = end + 1 + vector_bytes
+    vectors = np.array(vectors, dtype=np.float32).reshape(-1, vector_size)
+    return words, vectors
+
+
+def load_subset_cache(model_name: str, source_path: str, vocab, loader, binary: bool = None):
+    """ Load a model restricted to the words of `vocab`, cached in the native format under a name keyed by the hash of
+    the vocabulary. The subset is gathered from the native cache when it is available, otherwise streamed from the
+    source file in a single pass.
+
+    :param model_name: name of the model
+    :param source_path: original embedding file
+    :param vocab: words to keep
+    :param loader: function returning the model parsed from `source_path`, to build the native cache if needed
+    :param binary: format of the source (True for binary word2vec, False for text word2vec, None if it can not be
+        streamed, which is loaded via the native cache)
+    """
+    from gensim.models import KeyedVectors
+    vocab = sorted(set(vocab))
+    digest = hashlib.blake2b('\n'.join(vocab).encode('utf-8'), digest_size=8).hexdigest()
+    os.makedirs(SUBSET_CACHE_DIR, exist_ok=True)
+    cache_path = '{}/{}.{}.kv'.format(SUBSET_CACHE_DIR, model_name, digest)
+    if _is_cache_valid(cache_path, source_path):
+        return KeyedVectors.load(cache_path, mmap='r')
+    logging.info('building subset of {} ({} words): {}'.format(model_name, len(vocab), cache_path))
+    if binary is None or _is_cache_valid(_native_cache_path(model_name), source_path):
+        model = load_native_cache(model_name, source_path, loader)
+        matrix, found = get_embedding_matrix(vocab, model)
+        model = getattr(model, 'wv', model)
+        # keep the order of the model, and put words found only by subword information at last
+        index = [model.vocab[w].index if w in model.vocab else len(model.vocab) for w in vocab]
+        order = [n for n in sorted(range(len(vocab)), key=lambda n: index[n]) if found[n]]
+        words, vectors = [vocab[n] for n in order], matrix[order]
+    else:
+        words, vectors = _stream_word2vec(source_path, binary, set(vocab))
+    logging.info('\t * {} out of {} words are found'.format(len(words), len(vocab)))
+    subset = KeyedVectors(vectors.shape[1])
+    subset.add(words, vectors)
+    _save_cache(subset, cache_path, source_path)
+    return KeyedVectors.load(cache_path, mmap='r')
+
+
+def get_word_embedding_model(model_name: str = 'fasttext', native_cache: bool = True, subset: bool = False):
+    """ get word embedding model
+
+    :param model_name: name of the model
+    :param native_cache: load via the memory-mapped native cache (built on the first call) instead of parsing the
+        source file
+    :param subset: load only the words (or the word pairs of pair embedding models) of the benchmark datasets, see
+        `benchmark_vocab.get_model_vocab`
+    """
+    # gensim takes a few seconds to import, so it is imported only when a model is loaded
+    from gensim.models import KeyedVectors
+    from gensim.models import fasttext
     os.makedirs('./cache', exist_ok=True)
     if model_name == 'w2v':
         path = './cache/GoogleNews-vectors-negative300.bin'
@@ -22,7 +172,8 @@ def get_word_embedding_model(model_name: str = 'fasttext'):
                 cache_dir='./cache',
                 gdrive_filename='GoogleNews-vectors-negative300.bin.gz'
             )
-        model = KeyedVectors.load_word2vec_format(path, binary=True)
+        loader = lambda: KeyedVectors.load_word2vec_format(path, binary=True)
+        binary = True
     elif model_name == 'fasttext_cc':
         path = './cache/crawl-300d-2M-subword.bin'
         if not os.path.exists(path):
@@ -30,8 +181,9 @@ def get_word_embedding_model(model_name: str = 'fasttext'):
             wget(
                 url='https://dl.fbaipublicfiles.com/fasttext/vectors-english/crawl-300d-2M-subword.zip',
                 cache_dir='./cache')
-        model = fasttext.load_facebook_model(path)
-        # model = KeyedVectors.load_word2vec_format(path)
+        loader = lambda: fasttext.load_facebook_model(path)
+        binary = None
+        # loader = lambda: KeyedVectors.load_word2vec_format(path)
     elif model_name == 'fasttext':
         path = './cache/wiki-news-300d-1M.vec'
         if not os.path.exists(path):
@@ -40,7 +192,8 @@ def get_word_embedding_model(model_name: str = 'fasttext'):
                 url='https://dl.fbaipublicfiles.com/fasttext/vectors-english/wiki-news-300d-1M.vec.zip',
                 cache_dir='./cache'
             )
-        model = KeyedVectors.load_word2vec_format(path)
+        loader = lambda: KeyedVectors.load_word2vec_format(path)
+        binary = False
     elif model_name == 'glove':
         path = './cache/glove.840B.300d.gensim.bin'
         if not os.path.exists(path):
@@ -50,7 +203,8 @@ def get_word_embedding_model(model_name: str = 'fasttext'):
                 cache_dir='./cache',
                 gdrive_filename='glove.840B.300d.gensim.bin.tar.gz'
             )
-        model = KeyedVectors.load_word2vec_format(path, binary=True)
+        loader = lambda: KeyedVectors.load_word2vec_format(path, binary=True)
+        binary = True
     elif model_name == 'pair2vec':
         path = './cache/pair2vec.fasttext.bin'
         if not os.path.exists(path):
@@ -58,49 +212,270 @@ def get_word_embedding_model(model_name: str = 'fasttext'):
             wget(
                 url='https://github.com/asahi417/AnalogyTools/releases/download/0.0.0/pair2vec.fasttext.bin.tar.gz',
                 cache_dir='./cache')
-        model = KeyedVectors.load_word2vec_format(path, binary=True)
+        loader = lambda: KeyedVectors.load_word2vec_format(path, binary=True)
+        binary = True
     else:
         path = './cache/{}.bin'.format(model_name)
         if not os.path.exists(path):
             print('downloading {}'.format(model_name))
             wget(url='https://github.com/asahi417/AnalogyTools/releases/download/0.0.0/{}.bin.tar.gz'.format(model_name),
                  cache_dir='./cache')
-        model = KeyedVectors.load_word2vec_format(path, binary=True)
-    return model
+        loader = lambda: KeyedVectors.load_word2vec_format(path, binary=True)
+        binary = True
+    if subset:
+        from benchmark_vocab import get_model_vocab
+        return load_subset_cache(model_name, path, get_model_vocab(model_name), loader, binary)
+    if not native_cache:
+        return loader()
+    return load_native_cache(model_name, path, loader)
 
 
-def wget(url, cache_dir: str, gdrive_filename: str = None):
-    """ wget and uncompress data_iterator """
-    path = _wget(url, cache_dir, gdrive_filename=gdrive_filename)
-    if path.endswith('.tar.gz') or path.endswith('.tgz') or path.endswith('.tar'):
-        if path.endswith('.tar'):
-            tar = tarfile.open(path)
+def get_embedding_matrix(terms, model):
+    """ Stack the vectors of `terms` into a float32 matrix with one fancy-index over `model.vectors`. Rows of terms
+    missing in `model` are zero.
+
+    :return: (matrix, found) where `found` is a boolean mask of the terms in `model`
+    """
+    model = getattr(model, 'wv', model)
+    matrix = np.zeros((len(terms), model.vector_size), dtype=np.float32)
+    index = np.array([model.vocab[t].index if t in model.vocab else -1 for t in terms], dtype=np.int64)
+    found = index >= 0
+    if found.any():
+        matrix[found] = model.vectors[index[found]]
+    # models with subword information (fasttext) still provide vectors of out-of-vocabulary terms
+    for n in np.flatnonzero(~found):
+        try:
+            matrix[n] = model[terms[n]]
+            found[n] = True
+        except KeyError:
+            pass
+    return matrix, found
+
+
+def _model_nbytes(model):
+    """ approximate memory footprint of a model by the size of its vector arrays """
+    model = getattr(model, 'wv', model)
+    return sum(v.nbytes for v in vars(model).values() if hasattr(v, 'nbytes'))
+
+
+class ModelRegistry:
+    """ Process-wide LRU registry of loaded embedding models within a memory budget """
+
+    def __init__(self, max_memory_gb: float = None):
+        if max_memory_gb is None:
+            max_memory_gb = float(os.getenv('MODEL_REGISTRY_GB', 32))
+        self.max_memory = int(max_memory_gb * 1024 ** 3)
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def memory(self):
+        return sum(size for _, size in self.models.values())
+
+    def get(self, model_name: str, **kwargs):
+        """ get a model by name, loading it with `get_word_embedding_model` on a miss """
+        key = (model_name,) + tuple(sorted(kwargs.items()))
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key][0]
+        self.misses += 1
+        model = get_word_embedding_model(model_name, **kwargs)
+        self.models[key] = (model, _model_nbytes(model))
+        # evict least recently used models but never the one just loaded
+        while self.memory > self.max_memory and len(self.models) > 1:
+            evicted, _ = self.models.popitem(last=False)
+            logging.info('model registry: evict {}'.format(evicted[0]))
+        return model
+
+    def clear(self):
+        self.models.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'models': [k[0] for k in self.models],
+                'memory_gb': self.memory / 1024 ** 3}
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def _truecase(word: str):
+    import truecase
+    return truecase.get_true_case('A ' + word)[2:]
+
+
+def truecase_words(words, processes: int = None, cache_path: str = './cache/truecase.json'):
+    """ Truecase words, each of which is truecased once over a pool of processes and kept in an on-disk cache
+
+    :param words: iterable of words, duplicated words are truecased only once
+    :param processes: number of worker processes (all cores if None)
+    :param cache_path: json file of word to truecased word, reused by later calls
+    :return: a dictionary of word to truecased word
+    """
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    words = set(words)
+    new_words = sorted(words - set(cache.keys()))
+    if len(new_words):
+        logging.info('truecasing {} words ({} cached)'.format(len(new_words), len(words) - len(new_words)))
+        with Pool(processes) as pool:
+            cache.update(zip(new_words, pool.map(_truecase, new_words, chunksize=1000)))
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    return {w: cache[w] for w in words}
+
+
+class Word2VecBinaryWriter:
+    """ Stream vectors into a binary word2vec format file, which is renamed from a temporary file on close after the
+    header is patched with the number of vectors """
+
+    header_size = 64
+
+    def __init__(self, path: str, vector_size: int):
+        self.path = path
+        self.vector_size = vector_size
+        self.count = 0
+        self.file = open(path + '.tmp', 'wb')
+        # placeholder of the header, overwritten on close
+        self.file.write(b' ' * (self.header_size - 1) + b'\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
         else:
-            tar = tarfile.open(path, "r:gz")
-        tar.extractall(cache_dir)
-        tar.close()
+            self.file.close()
+
+    def write(self, words, vectors):
+        """ write a batch of words and their vectors given as a (len(words), vector_size) array """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        assert vectors.shape == (len(words), self.vector_size), vectors.shape
+        for word, vector in zip(words, vectors):
+            self.file.write(word.encode('utf-8') + b' ' + vector.tobytes())
+        self.count += len(words)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write('{} {}'.format(self.count, self.vector_size).ljust(self.header_size - 1).encode('utf-8'))
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+def wget(url, cache_dir: str, gdrive_filename: str = None, checksum: str = None):
+    """ wget and uncompress data_iterator
+
+    :param checksum: sha256 hex digest of the downloaded file, verified when given
+    """
+    path = _wget(url, cache_dir, gdrive_filename=gdrive_filename, checksum=checksum)
+    if path.endswith('.tar.gz') or path.endswith('.tgz') or path.endswith('.tar'):
+        with tarfile.open(path, 'r' if path.endswith('.tar') else 'r:gz') as tar:
+            _extract_atomic(tar, cache_dir)
         os.remove(path)
     elif path.endswith('.gz'):
         with gzip.open(path, 'rb') as f:
-            with open(path.replace('.gz', ''), 'wb') as f_write:
-                f_write.write(f.read())
+            with open(path[:-len('.gz')] + '.tmp', 'wb') as f_write:
+                shutil.copyfileobj(f, f_write, CHUNK_SIZE)
+        os.replace(path[:-len('.gz')] + '.tmp', path[:-len('.gz')])
         os.remove(path)
     elif path.endswith('.zip'):
         with zipfile.ZipFile(path, 'r') as zip_ref:
-            zip_ref.extractall(cache_dir)
+            _extract_atomic(zip_ref, cache_dir)
         os.remove(path)
     # return path
 
 
-def _wget(url: str, cache_dir, gdrive_filename: str = None):
-    """ get data from web """
+def _extract_atomic(archive, cache_dir: str):
+    """ extract an archive into a temporary directory, then move its top level entries into `cache_dir` so that an
+    interrupted extraction never leaves partial files in `cache_dir` """
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.extract_')
+    try:
+        archive.extractall(tmp_dir)
+        for name in os.listdir(tmp_dir):
+            target = '{}/{}'.format(cache_dir, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace('{}/{}'.format(tmp_dir, name), target)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _sha256(path: str):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _download(url: str, part_path: str):
+    """ Stream `url` to `part_path`. An interrupted download is resumed by HTTP range request, guarded by `If-Range`
+    with the validator (ETag or Last-Modified) of the response it started from, kept in `{part_path}.json`, so that a
+    `.part` of an older version of the file is downloaded again from the start. A `.part` without the validator file is
+    never resumed. """
+    import requests
+    validator_path = part_path + '.json'
+    offset, headers = 0, {}
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        with open(validator_path, 'r') as f:
+            validator = json.load(f)['validator']
+        offset = os.path.getsize(part_path)
+        headers = {'Range': 'bytes={}-'.format(offset)}
+        if validator is not None:
+            headers['If-Range'] = validator
+    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+        if offset and r.status_code == 416:
+            # the range starts at or beyond the end of the file: the `.part` is complete only if it has the same size
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                return
+            logging.info('invalid partial download of {} ({} bytes), downloading again'.format(url, offset))
+            os.remove(part_path)
+            return _download(url, part_path)
+        r.raise_for_status()
+        if r.status_code == 206 and not r.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset)):
+            raise IOError('unexpected range of {}: {}'.format(url, r.headers.get('Content-Range')))
+        if r.status_code != 206:
+            # the server does not support range request, or the file has changed since the `.part` was started
+            offset = 0
+            with open(validator_path, 'w') as f:
+                json.dump({'validator': r.headers.get('ETag') or r.headers.get('Last-Modified')}, f)
+        size = None
+        if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+            size = int(r.headers['Content-Length'])
+        written = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        if size is not None and written != size:
+            raise IOError('incomplete download of {}: {}/{} bytes'.format(url, written, size))
+
+
+def _wget(url: str, cache_dir, gdrive_filename: str = None, checksum: str = None):
+    """ get data from web: stream to a `.part` file by `_download`, and rename it to the final path once complete (and
+    verified by `checksum` if given) """
     os.makedirs(cache_dir, exist_ok=True)
     if url.startswith('https://drive.google.com'):
         assert gdrive_filename is not None, 'please provide fileaname for gdrive download'
-        return gdown.download(url, '{}/{}'.format(cache_dir, gdrive_filename), quiet=False)
-    filename = os.path.basename(url)
-    with open('{}/{}'.format(cache_dir, filename), "wb") as f:
-        r = requests.get(url)
-        f.write(r.content)
-    return '{}/{}'.format(cache_dir, filename)
-
+        path = '{}/{}'.format(cache_dir, gdrive_filename)
+        import gdown
+        gdown.download(url, path + '.part', quiet=False)
+    else:
+        path = '{}/{}'.format(cache_dir, os.path.basename(url))
+        _download(url, path + '.part')
+    if checksum is not None and _sha256(path + '.part') != checksum:
+        os.remove(path + '.part')
+        if os.path.exists(path + '.part.json'):
+            os.remove(path + '.part.json')
+        raise ValueError('checksum mismatch: {}'.format(url))
+    os.replace(path + '.part', path)
+    if os.path.exists(path + '.part.json'):
+        os.remove(path + '.part.json')
+    return path